@@ -0,0 +1,178 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Compares the text layer allocations and render time of NotificationBuilder against the old full-canvas stitch_text.
+Run from anywhere with: python benchmarks/text_layers.py [renders]
+"""
+
+# Standard Library
+from io import BytesIO
+import os
+import sys
+import time
+
+# Third Party
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Local
+import notification_builder
+from notification_builder import NotificationBuilder
+from utilities import construct_trade_data
+
+themes_folder = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "themes"
+)
+
+
+class FullCanvasBuilder(NotificationBuilder):
+    """NotificationBuilder with the old stitch_text, which drew every text onto its own canvas sized layer"""
+
+    def stitch_text(
+        self,
+        background,
+        position,
+        text,
+        rgba=None,
+        font=None,
+        anchor="la",
+        stroke_rgba=None,
+        stroke_width=0,
+    ):
+        text_image = Image.new("RGBA", background.size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(text_image)
+        draw.text(
+            position,
+            text,
+            fill=rgba,
+            font=font,
+            anchor=anchor,
+            stroke_fill=stroke_rgba,
+            stroke_width=stroke_width,
+        )
+        background.paste(text_image, mask=text_image)
+        return background
+
+
+class AllocationCounter:
+    """Counts the bytes of every RGBA image created through notification_builder.Image.new"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.new = Image.new
+
+    def __enter__(self):
+        def counting_new(mode, size, *args, **kwargs):
+            self.bytes += size[0] * size[1] * len(mode)
+            return self.new(mode, size, *args, **kwargs)
+
+        notification_builder.Image.new = counting_new
+        return self
+
+    def __exit__(self, *exc):
+        notification_builder.Image.new = self.new
+
+
+class ValueIndex:
+    def value(self, asset_id):
+        return 1000 * int(asset_id)
+
+    def __contains__(self, asset_id):
+        return True
+
+
+def sample_trade():
+    """Returns trade_data and thumbnails for a 4 for 4 trade"""
+    offers = []
+    for user_id, asset_ids in ((1, (11, 12, 13, 14)), (2, (21, 22, 23, 24))):
+        offers.append(
+            {
+                "user": {"id": user_id, "name": f"user{user_id}", "displayName": f"User {user_id}"},
+                "userAssets": [
+                    {
+                        "id": asset_id * 100,
+                        "serialNumber": asset_id,
+                        "assetId": asset_id,
+                        "name": f"Limited {asset_id}",
+                        "recentAveragePrice": asset_id * 500,
+                        "originalPrice": None,
+                        "assetStock": None,
+                        "membershipType": "None",
+                    }
+                    for asset_id in asset_ids
+                ],
+                "robux": 0,
+            }
+        )
+    trade_data = construct_trade_data(
+        {"offers": offers}, ValueIndex(), 1, True, "Completed"
+    )
+    asset_images = {}
+    for offer in offers:
+        for asset in offer["userAssets"]:
+            image_bytes = BytesIO()
+            Image.new("RGBA", (700, 700), (asset["assetId"] * 9, 120, 200, 255)).save(
+                image_bytes, "PNG"
+            )
+            asset_images[str(asset["assetId"])] = image_bytes.getvalue()
+    return trade_data, asset_images
+
+
+def measure(builder, trade_data, asset_images, renders, cold_text=False):
+    """Returns the average text layer bytes allocated and seconds taken per render, and the last render.
+    With cold_text, the text strip cache is emptied before every render to measure text never seen before.
+    """
+    builder.build_image(trade_data, asset_images)  # Warm up caches
+    with AllocationCounter() as counter:
+        start = time.perf_counter()
+        for _ in range(renders):
+            if cold_text:
+                builder.text_cache.clear()
+            image = builder.build_image(trade_data, asset_images)
+        seconds = time.perf_counter() - start
+    return counter.bytes / renders, seconds / renders, image.data
+
+
+def main(renders: int = 20):
+    trade_data, asset_images = sample_trade()
+    print(
+        f"{'theme':<22}{'old alloc':>12}{'cold alloc':>12}{'warm alloc':>12}"
+        f"{'old ms':>10}{'cold ms':>10}{'warm ms':>10}  identical"
+    )
+    for theme_name in sorted(os.listdir(themes_folder)):
+        theme_folder = os.path.join(themes_folder, theme_name)
+        old_bytes, old_seconds, old_image = measure(
+            FullCanvasBuilder(theme_folder), trade_data, asset_images, renders
+        )
+        builder = NotificationBuilder(theme_folder)
+        cold_bytes, cold_seconds, _ = measure(
+            builder, trade_data, asset_images, renders, cold_text=True
+        )
+        new_bytes, new_seconds, new_image = measure(
+            builder, trade_data, asset_images, renders
+        )
+        identical = (
+            Image.open(BytesIO(old_image)).tobytes()
+            == Image.open(BytesIO(new_image)).tobytes()
+        )
+        print(
+            f"{theme_name:<22}{old_bytes / 1024 / 1024:>10.2f}MB{cold_bytes / 1024 / 1024:>10.2f}MB"
+            f"{new_bytes / 1024 / 1024:>10.2f}MB{old_seconds * 1000:>10.1f}"
+            f"{cold_seconds * 1000:>10.1f}{new_seconds * 1000:>10.1f}  {identical}"
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
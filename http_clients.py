@@ -0,0 +1,73 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import logging
+
+# Third Party
+import httpx
+
+try:
+    import h2  # Only needed for HTTP/2, which httpx supports when installed with httpx[http2]
+except ImportError:
+    h2 = None
+
+logger = logging.getLogger("horizon.http_clients")
+
+
+class ClientRegistry:
+    """Holds one pooled keep-alive httpx.AsyncClient per upstream host so connections get reused between calls.
+    Clients are created lazily on first use, and must be closed with aclose() on shutdown.
+    """
+
+    HOSTS = ("thumbnails", "rbxcdn", "rolimons", "discord", "github")
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        http2: bool = False,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        if http2 and h2 is None:
+            logger.warning(
+                "HTTP/2 was enabled but the h2 package isn't installed, falling back to HTTP/1.1"
+            )
+            http2 = False
+        self.http2 = http2
+        self.clients = {}
+
+    def get(self, host: str):
+        """Returns the shared client for host, which must be one of ClientRegistry.HOSTS"""
+        if host not in self.HOSTS:
+            raise KeyError(f"Unknown client host: {host}")
+        if host not in self.clients:
+            logger.debug(f"Creating pooled {host} client")
+            self.clients[host] = self.create_client()
+        return self.clients[host]
+
+    def create_client(self, **kwargs):
+        """Creates a new client with the registry's pool limits and HTTP/2 setting. The caller is responsible for closing it."""
+        return httpx.AsyncClient(limits=self.limits, http2=self.http2, **kwargs)
+
+    async def aclose(self):
+        """Closes every client the registry has created"""
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients = {}
+        logger.info("Closed pooled http clients")
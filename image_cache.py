@@ -0,0 +1,183 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import asyncio
+from collections import OrderedDict
+from io import BytesIO
+import logging
+import mmap
+import os
+import traceback
+
+# Third Party
+from PIL import Image  # Pillow
+import httpx
+
+# Local
+from metrics import cache_samples
+from utilities import get_image_bytes_from_url
+
+logger = logging.getLogger("horizon.image_cache")
+
+
+class ThumbnailCache:
+    """On-disk cache of item thumbnails, stored as one file per asset id and thumbnail size.
+    Limiteds show up in trade after trade, so after warm-up most notifications need no image downloads at all.
+    """
+
+    def __init__(
+        self, folder: str, max_concurrent_downloads: int = 8, use_mmap: bool = False
+    ):
+        self.folder = folder
+        self.use_mmap = use_mmap
+        self.semaphore = asyncio.Semaphore(max_concurrent_downloads)
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def path(self, asset_id, size: str):
+        """Returns the file path an asset's thumbnail of size is cached at"""
+        return os.path.join(self.folder, f"{int(asset_id)}_{size}.png")
+
+    def get(self, asset_id, size: str):
+        """Returns the cached image bytes for asset_id at size, or None if it isn't cached"""
+        path = self.path(asset_id, size)
+        try:
+            with open(path, "rb") as file:
+                if self.use_mmap:
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        data = mapped[:]
+                else:
+                    data = file.read()
+        except (FileNotFoundError, ValueError):  # ValueError is raised when mapping an empty file
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def collect(self):
+        """Returns metrics samples for the cache's hit ratio"""
+        return cache_samples("thumbnails", self.hits, self.misses)
+
+    def put(self, asset_id, size: str, data: bytes):
+        """Writes image bytes to the cache. Written to a temporary file first so a crash can never leave a half-written image behind."""
+        path = self.path(asset_id, size)
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+
+    async def download(self, urls: dict, size: str, client: httpx.AsyncClient = None):
+        """Concurrently downloads and caches thumbnails, at most max_concurrent_downloads at a time.
+        urls should be a dict of str asset id to thumbnail url, as returned by ThumbnailResolver.resolve
+        Returns a dict of str asset id to image bytes. Thumbnails that fail to download are left out.
+        """
+        results = await asyncio.gather(
+            *(self._download(asset_id, url, size, client) for asset_id, url in urls.items())
+        )
+        return {
+            asset_id: data for asset_id, data in zip(urls, results) if data is not None
+        }
+
+    async def _download(
+        self, asset_id: str, url: str, size: str, client: httpx.AsyncClient
+    ):
+        async with self.semaphore:
+            try:
+                data = await get_image_bytes_from_url(url, client=client)
+            except (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.ConnectError):
+                logger.warning(
+                    f"Timed out while downloading thumbnail for asset {asset_id}: {traceback.format_exc()}"
+                )
+                return None
+            except Exception:  # Such as the CDN answering 403 or 404, which only costs this item its image
+                logger.error(
+                    f"Error while downloading thumbnail for asset {asset_id}: {traceback.format_exc()}"
+                )
+                return None
+        try:
+            Image.open(BytesIO(data)).verify()
+        except Exception:  # Caching a body that isn't an image would break the item in every later trade
+            logger.error(
+                f"Downloaded thumbnail for asset {asset_id} isn't a valid image: {traceback.format_exc()}"
+            )
+            return None
+        self.put(asset_id, size, data)
+        return data
+
+
+class ResizedImageCache:
+    """In-memory LRU cache of decoded item images already resized to a theme slot, ready to paste as RGBA.
+    Entries are keyed by asset id and size, and the least recently used are evicted once the cache holds more than max_bytes of pixels.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.images = OrderedDict()
+
+    def get(self, asset_id, size: tuple):
+        """Returns the cached image for asset_id at size, or None on a miss"""
+        key = (int(asset_id), tuple(size))
+        image = self.images.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.images.move_to_end(key)
+        self.hits += 1
+        return image
+
+    def put(self, asset_id, size: tuple, image: Image.Image):
+        """Adds an image to the cache, evicting the least recently used images until it fits in max_bytes"""
+        key = (int(asset_id), tuple(size))
+        image_bytes = self.image_bytes(image)
+        if image_bytes > self.max_bytes:
+            return
+        if key in self.images:
+            self.current_bytes -= self.image_bytes(self.images.pop(key))
+        self.images[key] = image
+        self.current_bytes += image_bytes
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self.images.popitem(last=False)
+            self.current_bytes -= self.image_bytes(evicted)
+
+    def get_or_create(self, asset_id, size: tuple, image_bytes: bytes):
+        """Returns the cached image for asset_id at size, decoding and resizing image_bytes into the cache on a miss"""
+        image = self.get(asset_id, size)
+        if image is None:
+            image = (
+                Image.open(BytesIO(image_bytes))
+                .convert("RGBA")
+                .resize(tuple(size), resample=Image.LANCZOS)
+            )
+            self.put(asset_id, size, image)
+        return image
+
+    def stats(self):
+        """Returns a dict of hits, misses, number of cached images and bytes used"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "images": len(self.images),
+            "bytes": self.current_bytes,
+        }
+
+    @staticmethod
+    def image_bytes(image: Image.Image):
+        return image.width * image.height * len(image.getbands())
@@ -0,0 +1,156 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+
+# Local
+from metrics import metrics
+from utilities import print_timestamp
+
+SPANS = (  # Name, start, end
+    ("detection", "created", "detected"),
+    ("processing", "detected", "rendered"),
+    ("delivery", "rendered", "delivered"),
+    ("total", "created", "delivered"),
+)
+PERCENTILES = (50, 90, 99)
+
+
+def parse_roblox_time(timestamp: str):
+    """Returns a Roblox API timestamp like "2021-03-17T02:56:19.557Z" as seconds since the epoch, or None if it can't be read"""
+    try:
+        seconds, _, fraction = timestamp.rstrip("Z").partition(".")
+        parsed = datetime.strptime(seconds, "%Y-%m-%dT%H:%M:%S").replace(
+            tzinfo=timezone.utc
+        )
+        return parsed.timestamp() + (float(f"0.{fraction}") if fraction.isdigit() else 0)
+    except (AttributeError, ValueError):
+        return None
+
+
+class LatencyTracker:
+    """Keeps track of how long each trade takes from being created on Roblox to its notification being accepted by discord.
+    Every interval seconds, percentiles of the latest window trades of each trade type are written to a rolling stats file,
+    and printed too if console is True. Trade creation times come from Roblox's clock, so the detection and total spans
+    also include any difference between it and the local clock.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        window: int = 1000,
+        interval: float = 300,
+        console: bool = False,
+        max_bytes: int = 1024 * 1024,
+        backup_count: int = 3,
+    ):
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.window = window
+        self.interval = interval
+        self.console = console
+        self.records = {}  # trade type: deque of {span name: seconds}
+        self.new_records = 0
+        self.stats_logger = logging.getLogger("horizon.latency.stats")
+        self.stats_logger.propagate = False
+        self.stats_logger.setLevel(logging.INFO)
+        handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count
+        )
+        handler.setFormatter(logging.Formatter("%(asctime)s | %(message)s"))
+        self.stats_logger.addHandler(handler)
+
+    def record(
+        self,
+        trade_type: str,
+        created: float,
+        detected: float,
+        rendered: float,
+        delivered: float,
+    ):
+        """Records one trade's timestamps, all in seconds since the epoch. created can be None if Roblox didn't give it."""
+        times = {
+            "created": created,
+            "detected": detected,
+            "rendered": rendered,
+            "delivered": delivered,
+        }
+        spans = {}
+        for name, start, end in SPANS:
+            if times[start] is None or times[end] is None:
+                continue
+            spans[name] = times[end] - times[start]
+            metrics.observe(
+                "horizon_trade_latency_seconds",
+                spans[name],
+                trade_type=trade_type,
+                span=name,
+            )
+        if trade_type not in self.records:
+            self.records[trade_type] = deque(maxlen=self.window)
+        self.records[trade_type].append(spans)
+        self.new_records += 1
+
+    def summary(self):
+        """Returns {trade type: {span name: {"count", "p50", "p90", "p99", "max"}}} for the trades in the window"""
+        summary = {}
+        for trade_type, records in self.records.items():
+            summary[trade_type] = {}
+            for name, _, _ in SPANS:
+                values = sorted(spans[name] for spans in records if name in spans)
+                if not values:
+                    continue
+                stats = {"count": len(values), "max": values[-1]}
+                for percentile in PERCENTILES:
+                    rank = max(0, -(-len(values) * percentile // 100) - 1)  # Nearest rank
+                    stats[f"p{percentile}"] = values[rank]
+                summary[trade_type][name] = stats
+        return summary
+
+    def format_summary(self, trade_type: str, spans: dict):
+        count = max(stats["count"] for stats in spans.values())
+        parts = [f"{trade_type} latency over the last {count} trades"]
+        for name, stats in spans.items():
+            percentiles = " ".join(
+                f"p{percentile} {stats[f'p{percentile}']:.1f}s"
+                for percentile in PERCENTILES
+            )
+            parts.append(f"{name} {percentiles} max {stats['max']:.1f}s")
+        return " | ".join(parts)
+
+    def write_summary(self):
+        """Writes the current summary to the stats file, and the console if enabled"""
+        for trade_type, spans in self.summary().items():
+            if not spans:
+                continue
+            line = self.format_summary(trade_type, spans)
+            self.stats_logger.info(line)
+            if self.console:
+                print_timestamp(line)
+        self.new_records = 0
+
+    async def run(self):
+        """Writes a summary every interval seconds, whenever trades have been recorded since the last one"""
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.new_records:
+                self.write_summary()
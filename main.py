@@ -16,6 +16,7 @@
 # Standard Library
 import asyncio
 import logging
+import multiprocessing
 import os
 import sys
 import traceback
@@ -24,8 +25,19 @@ import traceback
 import httpx
 
 # Local
+from http_clients import ClientRegistry
+from image_cache import ThumbnailCache
+from latency import LatencyTracker
+from metrics import metrics
+from pipeline import Pipeline
+from poll_scheduler import PollScheduler
+from rate_limiter import RateLimiter, RateLimited
+from thumbnail_resolver import ThumbnailResolver
+from render_pool import RenderPool
+from rolimons import RoliCache
 from trade_worker import TradeWorker
 from user import User
+from webhook_outbox import WebhookOutbox
 from utilities import (
     load_config,
     setup_logging,
@@ -58,16 +70,78 @@ async def main():
         f"Horizon Trade Notifier {version} - https://discord.gg/Xu8pqDWmgE - https://github.com/JartanFTW",
     )
 
+    clients = ClientRegistry(
+        max_connections=config["max_connections"],
+        max_keepalive_connections=config["max_keepalive_connections"],
+        http2=config["http2"],
+    )
+
+    rate_limiter = RateLimiter(
+        family_requests_per_minute=config["family_requests_per_minute"],
+        account_requests_per_minute=config["cookie_requests_per_minute"],
+        max_retries=config["max_rate_limit_retries"],
+    )
+
     users = []
     for cookie in config["cookies"]:
-        try:
-            user = await User.create(cookie)
-            users.append(user)
-        except InvalidCookie:
-            print_timestamp(f"An invalid cookie was detected: {cookie}")
-            continue
+        while True:
+            try:
+                user = await User.create(
+                    cookie, clients=clients, rate_limiter=rate_limiter
+                )
+                users.append(user)
+            except InvalidCookie:
+                print_timestamp(f"An invalid cookie was detected: {cookie}")
+            except RateLimited:  # Roblox is still answering 429 after every retry, so wait and log the account in again
+                print_timestamp(
+                    f"Rate limited while logging in, retrying in {rate_limiter.max_delay:.0f} seconds"
+                )
+                await asyncio.sleep(rate_limiter.max_delay)
+                continue
+            break
+    tasks = []
     if users:
-        tasks = []
+        roli_cache = RoliCache(
+            ttl=config["roli_data_ttl"], client=clients.get("rolimons")
+        )
+        thumbnails = ThumbnailCache(
+            os.path.join(main_folder_path, "cache", "thumbnails"),
+            max_concurrent_downloads=config["max_concurrent_downloads"],
+            use_mmap=config["mmap_thumbnail_cache"],
+        )
+        scheduler = PollScheduler(
+            global_requests_per_minute=config["global_requests_per_minute"],
+            account_requests_per_minute=config["account_requests_per_minute"],
+        )
+        thumbnail_resolver = ThumbnailResolver(
+            client=clients.get("thumbnails"),
+            rate_limiter=rate_limiter,
+            window=config["thumbnail_batch_window_ms"] / 1000,
+            ttl=config["thumbnail_url_ttl"],
+        )
+        render_pool = RenderPool(
+            processes=config["render_processes"],
+            image_cache_bytes=config["image_cache_size_mb"] * 1024 * 1024,
+        )
+        pipeline = Pipeline(
+            queue_size=config["pipeline_queue_size"],
+            enrich_workers=config["enrich_workers"],
+            image_workers=config["image_workers"],
+            render_workers=config["render_workers"] or max(1, config["render_processes"]),
+            deliver_workers=config["deliver_workers"],
+        )
+        outbox = WebhookOutbox(
+            os.path.join(main_folder_path, "data", "outbox.sqlite"),
+            client=clients.get("discord"),
+            coalesce=config["coalesce_notifications"],
+            coalesce_window=config["coalesce_window"],
+        )
+        latency = LatencyTracker(
+            os.path.join(main_folder_path, "logs", "latency_stats.log"),
+            window=config["latency_window"],
+            interval=config["latency_stats_interval"],
+            console=config["latency_console"],
+        )
         max_username_length = max([len(user.display_name) for user in users])
         for user in users:
             if config["completed"]["enabled"]:
@@ -77,13 +151,25 @@ async def main():
                     config["completed"]["webhook"],
                     config["completed"]["update_interval"],
                     config["completed"]["theme_name"],
+                    roli_cache,
+                    clients,
+                    thumbnails,
+                    thumbnail_resolver,
+                    render_pool,
+                    pipeline,
+                    outbox,
+                    latency,
                     trade_type="Completed",
                     add_unvalued_to_value=config["add_unvalued_to_value"],
                     testing=config["testing"],
                     webhook_content=config["completed"]["webhook_content"],
                     max_username_length=max_username_length,
+                    seen_trades_window=config["seen_trades_window"],
+                    adaptive_polling=config["adaptive_polling"],
+                    min_update_interval=config["min_update_interval"],
+                    max_update_interval=config["max_update_interval"],
                 )
-                tasks.append(asyncio.create_task(worker.check_trade_loop()))
+                scheduler.add(worker)
             if config["inbound"]["enabled"]:
                 worker = await TradeWorker.create(
                     main_folder_path,
@@ -91,14 +177,26 @@ async def main():
                     config["inbound"]["webhook"],
                     config["inbound"]["update_interval"],
                     config["inbound"]["theme_name"],
+                    roli_cache,
+                    clients,
+                    thumbnails,
+                    thumbnail_resolver,
+                    render_pool,
+                    pipeline,
+                    outbox,
+                    latency,
                     trade_type="Inbound",
                     add_unvalued_to_value=config["add_unvalued_to_value"],
                     testing=config["testing"],
                     double_check=config["double_check"],
                     webhook_content=config["inbound"]["webhook_content"],
                     max_username_length=max_username_length,
+                    seen_trades_window=config["seen_trades_window"],
+                    adaptive_polling=config["adaptive_polling"],
+                    min_update_interval=config["min_update_interval"],
+                    max_update_interval=config["max_update_interval"],
                 )
-                tasks.append(asyncio.create_task(worker.check_trade_loop()))
+                scheduler.add(worker)
             if config["outbound"]["enabled"]:
                 worker = await TradeWorker.create(
                     main_folder_path,
@@ -106,15 +204,50 @@ async def main():
                     config["outbound"]["webhook"],
                     config["outbound"]["update_interval"],
                     config["outbound"]["theme_name"],
+                    roli_cache,
+                    clients,
+                    thumbnails,
+                    thumbnail_resolver,
+                    render_pool,
+                    pipeline,
+                    outbox,
+                    latency,
                     trade_type="Outbound",
                     add_unvalued_to_value=config["add_unvalued_to_value"],
                     testing=config["testing"],
                     webhook_content=config["outbound"]["webhook_content"],
                     max_username_length=max_username_length,
+                    seen_trades_window=config["seen_trades_window"],
+                    adaptive_polling=config["adaptive_polling"],
+                    min_update_interval=config["min_update_interval"],
+                    max_update_interval=config["max_update_interval"],
                 )
-                tasks.append(asyncio.create_task(worker.check_trade_loop()))
+                scheduler.add(worker)
+        for source in (thumbnails, thumbnail_resolver, render_pool, pipeline, outbox):
+            metrics.add_collector(source.collect)
+        metrics.add_collector(rate_limiter.collect)
+        metrics.add_collector(
+            lambda: [
+                (
+                    "horizon_roblox_rate_limited_total",
+                    {"account": user.display_name},
+                    user.rate_limited,
+                )
+                for user in users
+            ]
+        )
+        for worker in scheduler.workers:
+            metrics.add_collector(worker.collect)
+        if scheduler.workers:
+            tasks.append(asyncio.create_task(scheduler.run()))
+            tasks.append(asyncio.create_task(pipeline.run()))
+            tasks.append(asyncio.create_task(outbox.run()))
+            tasks.append(asyncio.create_task(latency.run()))
+            if config["metrics_port"]:
+                tasks.append(asyncio.create_task(metrics.serve(config["metrics_port"])))
 
     if tasks:
+        tasks.append(asyncio.create_task(roli_cache.refresh_loop()))
         if config["check_for_update"]:
             if config["completed"]["enabled"]:
                 webhook_url = config["completed"]["webhook"]
@@ -123,7 +256,9 @@ async def main():
             else:
                 webhook_url = config["outbound"]["webhook"]
             tasks.append(
-                asyncio.create_task(check_for_update_loop(version, webhook_url))
+                asyncio.create_task(
+                    check_for_update_loop(version, webhook_url, clients=clients)
+                )
             )
         await asyncio.wait(tasks)
     else:
@@ -135,10 +270,17 @@ async def main():
             )
     for user in users:
         await user.client.aclose()
+    if users:
+        render_pool.shutdown()
+        outbox.close()
+        for worker in scheduler.workers:
+            worker.seen_trades.close()
+    await clients.aclose()
     return
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Lets the render pool start worker processes from the compiled exe
     try:
         asyncio.run(main())
     except Exception:
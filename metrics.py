@@ -0,0 +1,241 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+import time
+import traceback
+
+logger = logging.getLogger("horizon.metrics")
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+METRICS = {  # name: (type, help)
+    "horizon_stage_seconds": (
+        "histogram",
+        "Time spent in each step of notifying a trade: poll, trade_info, values, thumbnail_urls, image_download, render, encode, delivery",
+    ),
+    "horizon_trade_latency_seconds": (
+        "histogram",
+        "Time between a trade being created, detected, rendered, and delivered, by span: detection, processing, delivery, total",
+    ),
+    "horizon_webhook_request_seconds": (
+        "histogram",
+        "Time taken by discord to answer each webhook request",
+    ),
+    "horizon_trades_detected_total": ("counter", "New trades detected"),
+    "horizon_pipeline_jobs_total": (
+        "counter",
+        "Trades handled by each pipeline stage, by whether they passed, were dropped, or failed with an error",
+    ),
+    "horizon_queue_depth": ("gauge", "Trades or notifications waiting in each queue"),
+    "horizon_roblox_rate_limited_total": (
+        "counter",
+        "429 responses received from Roblox for each account",
+    ),
+    "horizon_roblox_family_rate_limited_total": (
+        "counter",
+        "429 responses received from Roblox for each endpoint family, including requests made without an account",
+    ),
+    "horizon_roblox_retry_seconds_total": (
+        "counter",
+        "Time spent waiting to retry Roblox requests after 429 responses",
+    ),
+    "horizon_roblox_delayed_total": (
+        "counter",
+        "Roblox requests held back to stay within the request budget",
+    ),
+    "horizon_roblox_delayed_seconds_total": (
+        "counter",
+        "Time Roblox requests spent held back to stay within the request budget",
+    ),
+    "horizon_webhook_notifications_total": (
+        "counter",
+        "Notifications sent to or rejected by discord",
+    ),
+    "horizon_webhook_messages_total": ("counter", "Webhook messages sent to discord"),
+    "horizon_webhook_rate_limited_total": (
+        "counter",
+        "429 responses received from discord",
+    ),
+    "horizon_webhook_retries_total": (
+        "counter",
+        "Webhook requests retried after connection errors or discord server errors",
+    ),
+    "horizon_cache_hits_total": ("counter", "Lookups answered from each cache"),
+    "horizon_cache_misses_total": ("counter", "Lookups each cache couldn't answer"),
+    "horizon_cache_hit_ratio": ("gauge", "Share of lookups answered from each cache"),
+}
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last count is for values above every bucket
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Latency histograms, counters, and gauges for everything Horizon does, served in Prometheus text format.
+    Metrics are recorded with observe, increment, and set, and must be listed in METRICS. Values that other classes
+    already keep track of, like queue depths and cache hits, are read from collectors each time metrics are served.
+    A collector is a function returning (name, labels, value) samples.
+    """
+
+    def __init__(self):
+        self.values = {}  # name: {labels: value or Histogram}, where labels is a tuple of (label, value)
+        self.collectors = []
+
+    def samples(self, name: str):
+        if name not in METRICS:
+            raise KeyError(f"Unknown metric: {name}")
+        if name not in self.values:
+            self.values[name] = {}
+        return self.values[name]
+
+    def observe(self, name: str, value: float, **labels):
+        """Records value in the histogram name"""
+        samples = self.samples(name)
+        key = tuple(labels.items())
+        if key not in samples:
+            samples[key] = Histogram()
+        samples[key].observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        """Adds amount to the counter name"""
+        samples = self.samples(name)
+        key = tuple(labels.items())
+        samples[key] = samples.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        """Sets the gauge name to value"""
+        self.samples(name)[tuple(labels.items())] = value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Records how long the with block takes in the histogram name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        """Returns every metric's samples, including those from collectors"""
+        values = {name: dict(samples) for name, samples in self.values.items()}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    self.samples(name)
+                    values.setdefault(name, {})[tuple(labels.items())] = value
+            except Exception:
+                logger.error(f"Error while collecting metrics: {traceback.format_exc()}")
+        return values
+
+    def render(self):
+        """Returns every metric in Prometheus text format"""
+        lines = []
+        for name, samples in sorted(self.collect().items()):
+            metric_type, description = METRICS[name]
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples.items():
+                if metric_type != "histogram":
+                    lines.append(f"{name}{self.format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bucket, count in zip(BUCKETS + ("+Inf",), value.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{name}_bucket{self.format_labels(labels + (('le', bucket),))} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{self.format_labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def format_labels(self, labels: tuple):
+        if not labels:
+            return ""
+        formatted = ",".join(
+            f'{label}="{self.escape(value)}"' for label, value in labels
+        )
+        return f"{{{formatted}}}"
+
+    def escape(self, value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    async def serve(self, port: int, host: str = "127.0.0.1"):
+        """Serves metrics at http://host:port/metrics forever"""
+        server = await asyncio.start_server(self.handle_request, host, port)
+        logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (
+                b"\r\n",
+                b"\n",
+                b"",
+            ):  # Skipping headers
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in (
+                "/",
+                "/metrics",
+            ):
+                status = "200 OK"
+                body = self.render().encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def cache_samples(cache: str, hits: int, misses: int):
+    """Returns the collector samples for a cache's hits, misses, and hit ratio"""
+    lookups = hits + misses
+    return [
+        ("horizon_cache_hits_total", {"cache": cache}, hits),
+        ("horizon_cache_misses_total", {"cache": cache}, misses),
+        ("horizon_cache_hit_ratio", {"cache": cache}, hits / lookups if lookups else 0),
+    ]
+
+
+metrics = Metrics()  # Shared by everything in the process, like a logger
@@ -16,108 +16,408 @@
 # Standard Library
 from io import BytesIO
 import json
+import logging
 import os
 from collections import OrderedDict
+import time
+from typing import NamedTuple
 
 # Third Party
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, features
 
 # Local
-from utilities import format_text
+from image_cache import ResizedImageCache
+from templates import ItemContext, Template, TradeContext
+from trade_model import Trade
+
+logger = logging.getLogger("horizon.notification_builder")
+
+
+class RenderedImage(NamedTuple):
+    """An encoded notification image along with how long it took to make"""
+
+    data: bytes
+    file_extension: str
+    render_seconds: float
+    encode_seconds: float
 
 
 class NotificationBuilder(Exception):
-    def __init__(self, theme_folder: str):
+    themes = {}  # Compiled builders shared between workers, keyed by theme folder
+    max_cached_text = 512  # How many rendered text strips each builder keeps for reuse
+    default_output = {
+        "format": "png",
+        "compress_level": 6,
+        "quantize": False,
+        "colors": 256,
+        "lossless": True,
+        "quality": 80,
+        "method": 4,
+    }
+
+    @classmethod
+    def for_theme(cls, theme_folder: str, image_cache: ResizedImageCache = None):
+        """Returns the compiled NotificationBuilder for theme_folder, compiling it on first use.
+        Every worker using the same theme shares the same builder, so theme files are only ever read once.
+        """
+        theme_folder = os.path.abspath(theme_folder)
+        if theme_folder not in cls.themes:
+            cls.themes[theme_folder] = cls(theme_folder, image_cache=image_cache)
+        return cls.themes[theme_folder]
+
+    def __init__(self, theme_folder: str, image_cache: ResizedImageCache = None):
         self.theme_folder = theme_folder
+        self.image_cache = image_cache
+        self.text_cache = OrderedDict()
         self.load_settings(theme_folder)
-        pass
-
-    def build_image(self, trade_data: dict):
-        """Takes in trade data and builds notification according to theme_setup, in the order that it's written in theme_setup."""
-        notification = self.load_image(
+        self.compile_theme()
+
+    def compile_theme(self):
+        """Loads everything in theme_setup that doesn't change between notifications into self.plan, in the order it's drawn.
+        The background, drawn_images and fonts are loaded from disk here once, so building a notification never touches the theme folder.
+        Layers that don't depend on trade data are then flattened onto self.base.
+        """
+        self.background = self.load_image(
             os.path.join(self.theme_folder, self.settings["background_image"])
         )
+        self.output = self.load_output_settings(self.settings.get("output", {}))
+        fonts = {}
+        self.plan = []
         for section, details in self.settings.items():
-            if section == "background_image":
+            if section in ("background_image", "output"):
                 continue
 
             elif section in ("give", "take", "drawn_images"):
                 for item_name, item_details in details.items():
-                    background = notification
-
+                    if item_name == "grid" and section != "drawn_images":
+                        self.plan.append(self.compile_grid(section, item_details, fonts))
+                        continue
+                    size = tuple(item_details["size"])
+                    position = self.top_left_position(
+                        item_details["position"],
+                        size,
+                        item_details["center_on_position"],
+                    )
                     if section == "drawn_images":
-                        foreground = self.load_image(
-                            os.path.join(self.theme_folder, item_details["file_name"])
+                        foreground = self.resize_image(
+                            self.load_image(
+                                os.path.join(self.theme_folder, item_details["file_name"])
+                            ),
+                            size,
+                        )
+                        if not item_details["transparency"]:
+                            foreground = self.remove_transparency(foreground)
+                        self.plan.append(
+                            {"type": "image", "image": foreground, "position": position}
                         )
                     else:
-                        try:
-                            foreground = trade_data[section]["items"][item_name][
-                                "pillowImage"
-                            ]
-                        except KeyError:  # Catching keyerror for trades that have less than 4 items on a side
-                            continue
-
-                    foreground = self.resize_image(
-                        foreground, tuple(item_details["size"])
-                    )
+                        self.plan.append(
+                            {
+                                "type": "item",
+                                "side": section,
+                                "index": self.item_index(item_name),
+                                "size": size,
+                                "position": position,
+                                "transparency": item_details["transparency"],
+                            }
+                        )
 
-                    position = item_details["position"]
+            elif section == "drawn_text":
+                for text_details in details.values():
+                    self.plan.append(self.compile_text(text_details, fonts))
 
-                    if item_details["center_on_position"]:
-                        position[0] = int(
-                            round(position[0] - (item_details["size"][0] / 2))
-                        )
-                        position[1] = int(
-                            round(position[1] - (item_details["size"][1] / 2))
-                        )
-                    position = tuple(position)
+            else:
+                print(f"Unknown theme section: {section}")
+                continue
 
-                    transparency = item_details["transparency"]
+        self.flatten_static_layers()
+
+    def item_index(self, item_name: str):
+        """Returns the index in Side.items of a give or take entry named like "item1", or None if it isn't named after an item"""
+        if item_name.startswith("item") and item_name[4:].isdigit():
+            return int(item_name[4:]) - 1
+        return None
+
+    def compile_text(self, text_details: dict, fonts: dict):
+        """Returns the plan step for a drawn_text entry, loading its font into fonts if it isn't there already"""
+        font_key = (text_details["font_file"], text_details["font_size"])
+        if font_key not in fonts:
+            fonts[font_key] = self.load_font(
+                os.path.join(self.theme_folder, text_details["font_file"]),
+                font_size=text_details["font_size"],
+            )
+        return {
+            "type": "text",
+            "template": Template(text_details["text"]),
+            "position": tuple(text_details["position"]),
+            "rgba": tuple(text_details["rgba"]),
+            "font": fonts[font_key],
+            "anchor": "mm" if text_details["center_on_position"] else "la",
+            "stroke_rgba": tuple(text_details["stroke_rgba"]),
+            "stroke_width": text_details["stroke_width"],
+        }
+
+    def compile_grid(self, side: str, grid_details: dict, fonts: dict):
+        """Returns the plan step for a give or take "grid", which lays out however many items the trade has on that side.
+        The first item goes at position, and each next one spacing[0] to the right until there are columns in the row,
+        then the next row starts spacing[1] below. Only the first max_items items are drawn, or every item if it's 0.
+        The grid's own drawn_text is drawn for every item, positioned relative to the item's position.
+        """
+        size = tuple(grid_details["size"])
+        return {
+            "type": "grid",
+            "side": side,
+            "size": size,
+            "position": tuple(grid_details["position"]),
+            "center_on_position": grid_details["center_on_position"],
+            "transparency": grid_details["transparency"],
+            "columns": max(1, grid_details.get("columns", 4)),
+            "spacing": tuple(grid_details.get("spacing", (size[0], size[1]))),
+            "max_items": grid_details.get("max_items", 0),
+            "text": [
+                self.compile_text(text_details, fonts)
+                for text_details in grid_details.get("drawn_text", {}).values()
+            ],
+        }
+
+    def grid_position(self, step: dict, index: int):
+        """Returns the position of item number index + 1 of a grid step, as given in the theme"""
+        column = index % step["columns"]
+        row = index // step["columns"]
+        return (
+            step["position"][0] + column * step["spacing"][0],
+            step["position"][1] + row * step["spacing"][1],
+        )
 
-                    self.stitch_images(
-                        background, foreground, position, transparency=transparency
-                    )
-                    continue
+    def grid_box(self, step: dict):
+        """Returns the (left, top, right, bottom) box every item of a grid step fits in, or None if it has no fixed bounds"""
+        if step["text"] or not step["max_items"]:
+            return None
+        boxes = [
+            self.box(
+                self.top_left_position(
+                    self.grid_position(step, index),
+                    step["size"],
+                    step["center_on_position"],
+                ),
+                step["size"],
+            )
+            for index in range(step["max_items"])
+        ]
+        return (
+            min(box[0] for box in boxes),
+            min(box[1] for box in boxes),
+            max(box[2] for box in boxes),
+            max(box[3] for box in boxes),
+        )
 
-            elif section == "drawn_text":
-                for text_details in details.values():
-                    background = notification
-                    position = tuple(text_details["position"])
-                    text = format_text(text_details["text"], trade_data=trade_data)
-                    rgba = tuple(text_details["rgba"])
-                    font = self.load_font(
-                        os.path.join(self.theme_folder, text_details["font_file"]),
-                        font_size=text_details["font_size"],
-                    )
+    def flatten_static_layers(self):
+        """Draws every layer in self.plan that looks the same in every notification onto self.base, and removes it from the plan.
+        A static layer can only be moved onto the base if it doesn't overlap a dynamic layer drawn before it, otherwise it would end up underneath it.
+        Dynamic text and item grids with text or no max_items have no known bounds, so nothing static after them is moved.
+        """
+        self.base = self.background.copy()
+        draw = ImageDraw.Draw(self.base)
+        dynamic_boxes = []
+        unbounded = False
+        plan = []
+        for step in self.plan:
+            if step["type"] == "item":
+                dynamic_boxes.append(self.box(step["position"], step["size"]))
+                plan.append(step)
+                continue
 
-                    anchor = "la"
-                    if text_details["center_on_position"]:
-                        anchor = "mm"
-
-                    stroke_rgba = tuple(text_details["stroke_rgba"])
-                    stroke_width = text_details["stroke_width"]
-
-                    background = self.stitch_text(
-                        background,
-                        position,
-                        text,
-                        rgba=rgba,
-                        font=font,
-                        anchor=anchor,
-                        stroke_rgba=stroke_rgba,
-                        stroke_width=stroke_width,
-                    )
-                    continue
+            if step["type"] == "grid":
+                box = self.grid_box(step)
+                if box is None:
+                    unbounded = True
+                else:
+                    dynamic_boxes.append(box)
+                plan.append(step)
+                continue
 
+            if step["type"] == "text" and not step["template"].is_static:
+                unbounded = True
+                plan.append(step)
+                continue
+
+            if step["type"] == "image":
+                box = self.box(step["position"], step["image"].size)
             else:
-                print(f"Unknown theme section: {section}")
+                box = draw.textbbox(
+                    step["position"],
+                    step["template"].text.format(),
+                    font=step["font"],
+                    anchor=step["anchor"],
+                    stroke_width=step["stroke_width"],
+                )
+            if unbounded or any(self.overlaps(box, other) for other in dynamic_boxes):
+                plan.append(step)
                 continue
 
-        notification_bytes = BytesIO()
-        notification.save(notification_bytes, "PNG")
-        notification_bytes.seek(0)
+            if step["type"] == "image":
+                self.base.paste(step["image"], box=step["position"], mask=step["image"])
+            else:
+                self.stitch_text(
+                    self.base,
+                    step["position"],
+                    step["template"].text.format(),
+                    rgba=step["rgba"],
+                    font=step["font"],
+                    anchor=step["anchor"],
+                    stroke_rgba=step["stroke_rgba"],
+                    stroke_width=step["stroke_width"],
+                )
+        self.plan = plan
+
+    def box(self, position: tuple, size: tuple):
+        """Returns the (left, top, right, bottom) box of an image of size placed at position"""
+        return (position[0], position[1], position[0] + size[0], position[1] + size[1])
+
+    def overlaps(self, box: tuple, other: tuple):
+        """Returns True if the two (left, top, right, bottom) boxes overlap"""
+        return (
+            box[0] < other[2]
+            and other[0] < box[2]
+            and box[1] < other[3]
+            and other[1] < box[3]
+        )
 
-        return notification_bytes
+    def load_output_settings(self, output: dict):
+        """Fills in the theme's optional "output" section with defaults, falling back to PNG if this Pillow can't write WebP"""
+        output = {**self.default_output, **output}
+        output["format"] = output["format"].lower()
+        if output["format"] not in ("png", "webp"):
+            print(f"Unknown theme output format: {output['format']}, using png")
+            output["format"] = "png"
+        if output["format"] == "webp" and not features.check("webp"):
+            logger.warning("Pillow was built without WebP support, using png")
+            output["format"] = "png"
+        return output
+
+    def build_image(self, trade_data: Trade, asset_images: dict):
+        """Takes in trade data and builds notification according to theme_setup, in the order that it's written in theme_setup.
+        asset_images should be a dict of str asset id to thumbnail image bytes. Items without an image are left out.
+        Returns a RenderedImage encoded according to the theme's output settings.
+        """
+        start = time.perf_counter()
+        context = TradeContext(trade_data)
+        notification = self.base.copy()
+        for step in self.plan:
+            if step["type"] == "image":
+                notification.paste(
+                    step["image"], box=step["position"], mask=step["image"]
+                )
+
+            elif step["type"] == "item":
+                items = getattr(trade_data, step["side"]).items
+                if step["index"] is None or step["index"] >= len(items):
+                    continue
+                asset_id = items[step["index"]].asset_id
+                image_bytes = asset_images.get(str(asset_id))
+                if image_bytes is None:  # Items without a thumbnail are left out
+                    continue
+                foreground = self.load_item_image(asset_id, step["size"], image_bytes)
+                if foreground is None:
+                    continue
+                self.stitch_images(
+                    notification,
+                    foreground,
+                    step["position"],
+                    transparency=step["transparency"],
+                )
+
+            elif step["type"] == "grid":
+                self.draw_grid(notification, step, trade_data, asset_images, context)
+
+            elif step["type"] == "text":
+                self.draw_text(notification, step, step["position"], context)
+
+        render_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        data = self.encode_image(notification)
+        return RenderedImage(
+            data, self.output["format"], render_seconds, time.perf_counter() - start
+        )
+
+    def draw_grid(
+        self,
+        notification: Image,
+        step: dict,
+        trade_data: Trade,
+        asset_images: dict,
+        context: TradeContext,
+    ):
+        """Draws each item on the grid step's side of the trade, along with the grid's text for it"""
+        for index, item in enumerate(getattr(trade_data, step["side"]).items):
+            if step["max_items"] and index >= step["max_items"]:
+                break
+            position = self.grid_position(step, index)
+            image_bytes = asset_images.get(str(item.asset_id))
+            foreground = (
+                self.load_item_image(item.asset_id, step["size"], image_bytes)
+                if image_bytes is not None
+                else None
+            )
+            if foreground is not None:
+                self.stitch_images(
+                    notification,
+                    foreground,
+                    self.top_left_position(
+                        position, step["size"], step["center_on_position"]
+                    ),
+                    transparency=step["transparency"],
+                )
+            item_context = ItemContext(context, step["side"], index + 1)
+            for text_step in step["text"]:
+                self.draw_text(
+                    notification,
+                    text_step,
+                    (
+                        position[0] + text_step["position"][0],
+                        position[1] + text_step["position"][1],
+                    ),
+                    item_context,
+                )
+
+    def draw_text(self, notification: Image, step: dict, position: tuple, context):
+        """Draws a text step's template filled in from context at position"""
+        self.stitch_text(
+            notification,
+            position,
+            step["template"].format(context),
+            rgba=step["rgba"],
+            font=step["font"],
+            anchor=step["anchor"],
+            stroke_rgba=step["stroke_rgba"],
+            stroke_width=step["stroke_width"],
+        )
+
+    def encode_image(self, notification: Image):
+        """Encodes the finished notification according to self.output and returns the bytes.
+        png is written at compress_level (0-9, lower is faster but bigger), after being reduced to a palette of colors if quantize is true.
+        webp is written lossless, or lossy at quality (0-100). method (0-6) trades encoding speed for size in both cases.
+        """
+        notification_bytes = BytesIO()
+        if self.output["format"] == "webp":
+            notification.save(
+                notification_bytes,
+                "WEBP",
+                lossless=self.output["lossless"],
+                quality=self.output["quality"],
+                method=self.output["method"],
+            )
+        else:
+            if self.output["quantize"]:
+                notification = notification.quantize(
+                    colors=self.output["colors"], method=Image.FASTOCTREE
+                )
+            notification.save(
+                notification_bytes,
+                "PNG",
+                compress_level=self.output["compress_level"],
+            )
+        return notification_bytes.getvalue()
 
     def load_settings(self, theme_folder: str):
         """Loads a json file from the folder path provided + "theme_setup.json" into an OrderedDict as self.settings"""
@@ -135,6 +435,18 @@ class NotificationBuilder(Exception):
         image = Image.open(image_path).convert("RGBA")
         return image
 
+    def load_item_image(self, asset_id: int, size: tuple, image_bytes: bytes):
+        """Returns the item thumbnail in image_bytes decoded and resized to size, from self.image_cache when possible.
+        Returns None if image_bytes can't be decoded, so the item is left out like one without a thumbnail.
+        """
+        try:
+            if self.image_cache is not None:
+                return self.image_cache.get_or_create(asset_id, size, image_bytes)
+            return self.resize_image(self.load_image(BytesIO(image_bytes)), size)
+        except (OSError, SyntaxError, ValueError):  # Raised by Pillow for unidentified, truncated or corrupt images
+            logger.warning(f"Couldn't decode thumbnail for asset {asset_id}")
+            return None
+
     def stitch_images(
         self,
         background: Image,
@@ -144,22 +456,34 @@ class NotificationBuilder(Exception):
     ):
         """Places PIL foreground onto PIL background at the top_left_position, passing foreground as the mask if transparency is True, and then returns the background"""
         if not transparency:
-            mask = None
-            alpha = foreground.convert("RGBA").split()[
-                -1
-            ]  # Getting alpha channel of foreground
-            new_foreground = Image.new(
-                "RGBA", foreground.size, (255, 255, 255, 255)
-            )  # Creating image with white background
-            new_foreground.paste(
-                foreground, mask=alpha
-            )  # Placing foreground on white background to remove all transparency
-            foreground = new_foreground
+            foreground = self.remove_transparency(foreground)
 
         mask = foreground
 
         background.paste(foreground, box=top_left_position, mask=mask)
 
+    def remove_transparency(self, foreground: Image):
+        """Returns a copy of foreground placed on a white background, removing all transparency"""
+        alpha = foreground.convert("RGBA").split()[
+            -1
+        ]  # Getting alpha channel of foreground
+        new_foreground = Image.new(
+            "RGBA", foreground.size, (255, 255, 255, 255)
+        )  # Creating image with white background
+        new_foreground.paste(
+            foreground, mask=alpha
+        )  # Placing foreground on white background to remove all transparency
+        return new_foreground
+
+    def top_left_position(self, position: list, size: tuple, center_on_position: bool):
+        """Returns position as a tuple, moved from the center of an image of size to its top left corner if center_on_position is True"""
+        if center_on_position:
+            return (
+                int(round(position[0] - (size[0] / 2))),
+                int(round(position[1] - (size[1] / 2))),
+            )
+        return tuple(position)
+
     def stitch_text(
         self,
         background: Image,
@@ -171,11 +495,51 @@ class NotificationBuilder(Exception):
         stroke_rgba: tuple = None,
         stroke_width: int = 0,
     ):
-        """Pillow documentation explains it better than I could: https://pillow.readthedocs.io/en/stable/reference/ImageDraw.html#PIL.ImageDraw.ImageDraw.text"""
-        text_image = Image.new("RGBA", background.size, (0, 0, 0, 0))
+        """Pillow documentation explains it better than I could: https://pillow.readthedocs.io/en/stable/reference/ImageDraw.html#PIL.ImageDraw.ImageDraw.text
+        The text is drawn onto a transparent strip only as big as its bounding box, which is then pasted onto the background.
+        Strips are cached, so text repeated between notifications is only ever drawn once.
+        """
+        key = (text, font, rgba, anchor, stroke_rgba, stroke_width)
+        if key in self.text_cache:
+            self.text_cache.move_to_end(key)
+            text_image, offset = self.text_cache[key]
+        else:
+            text_image, offset = self.render_text(
+                text, rgba, font, anchor, stroke_rgba, stroke_width
+            )
+            self.text_cache[key] = (text_image, offset)
+            if len(self.text_cache) > self.max_cached_text:
+                self.text_cache.popitem(last=False)
+
+        if text_image is not None:
+            background.paste(
+                text_image,
+                box=(position[0] + offset[0], position[1] + offset[1]),
+                mask=text_image,
+            )
+        return background
+
+    def render_text(
+        self,
+        text: str,
+        rgba: tuple,
+        font: ImageFont,
+        anchor: str,
+        stroke_rgba: tuple,
+        stroke_width: int,
+    ):
+        """Draws text onto a transparent image cropped to its bounding box.
+        Returns the image, or None if the text draws nothing, along with the offset of its top left corner from the text position.
+        """
+        left, top, right, bottom = ImageDraw.Draw(Image.new("RGBA", (0, 0))).textbbox(
+            (0, 0), text, font=font, anchor=anchor, stroke_width=stroke_width
+        )
+        if right <= left or bottom <= top:
+            return None, (0, 0)
+        text_image = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
         draw = ImageDraw.Draw(text_image)
         draw.text(
-            position,
+            (-left, -top),
             text,
             fill=rgba,
             font=font,
@@ -183,8 +547,7 @@ class NotificationBuilder(Exception):
             stroke_fill=stroke_rgba,
             stroke_width=stroke_width,
         )
-        background.paste(text_image, mask=text_image)
-        return background
+        return text_image, (left, top)
 
     def resize_image(self, image: Image, size: tuple):
         """Resizes a pillow image and returns it"""
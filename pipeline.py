@@ -0,0 +1,147 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import asyncio
+import logging
+import time
+import traceback
+
+# Local
+from utilities import print_timestamp
+
+logger = logging.getLogger("horizon.pipeline")
+
+
+class TradeJob:
+    """A detected trade moving through the Pipeline, along with everything the stages have worked out for it so far"""
+
+    __slots__ = (
+        "worker",
+        "trade",
+        "detected",
+        "detected_at",
+        "rendered_at",
+        "trade_data",
+        "asset_images",
+        "rendered",
+    )
+
+    def __init__(self, worker, trade: dict):
+        self.worker = worker
+        self.trade = trade
+        self.detected = time.monotonic()
+        self.detected_at = time.time()  # Wall clock times, to compare with when Roblox says the trade was created
+        self.rendered_at = None
+        self.trade_data = None  # The Trade built by the enrich stage
+        self.asset_images = None
+        self.rendered = None
+
+
+class Stage:
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.name = name
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.passed = 0
+        self.dropped = 0
+        self.failed = 0
+
+
+class Pipeline:
+    """Takes detected trades through to sent notifications in stages: enrich, fetch_images, render, and deliver.
+    Each stage has its own bounded queue and a fixed number of workers, which call the TradeWorker method of the same
+    name on each job. A method returns True to pass the job on to the next stage, or False to drop it.
+    When a stage falls behind its queue fills up, and the stages before it wait for space instead of piling up more
+    work, right back to the trade checks submitting new trades. Errors are logged and only drop the job they happened in.
+    Once a job leaves the pipeline, by getting through the deliver stage into the outbox or by being dropped, its TradeWorker's finish is called.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = 100,
+        enrich_workers: int = 4,
+        image_workers: int = 4,
+        render_workers: int = 1,
+        deliver_workers: int = 2,
+    ):
+        self.stages = [
+            Stage("enrich", enrich_workers, queue_size),
+            Stage("fetch_images", image_workers, queue_size),
+            Stage("render", render_workers, queue_size),
+            Stage("deliver", deliver_workers, queue_size),
+        ]
+        self.tasks = []
+
+    async def submit(self, job: TradeJob):
+        """Adds a job to the first stage, waiting for space if its queue is full"""
+        stage = self.stages[0]
+        if stage.queue.full():
+            logger.warning(
+                f"Pipeline {stage.name} queue is full with {stage.queue.qsize()} trades, waiting for space"
+            )
+        await stage.queue.put(job)
+
+    async def run(self):
+        """Runs every stage's workers forever"""
+        for position, stage in enumerate(self.stages):
+            next_stage = (
+                self.stages[position + 1] if position + 1 < len(self.stages) else None
+            )
+            for _ in range(stage.workers):
+                self.tasks.append(asyncio.create_task(self.work(stage, next_stage)))
+        await asyncio.gather(*self.tasks)
+
+    async def work(self, stage: Stage, next_stage: Stage):
+        while True:
+            job = await stage.queue.get()
+            try:
+                passed = await getattr(job.worker, stage.name)(job)
+            except Exception:
+                stage.failed += 1
+                passed = None
+                logger.error(
+                    f"{job.worker.user.display_name:>{job.worker.max_username_length}} | Error in {stage.name} stage for {job.worker.trade_type} trade {job.trade['id']}: {traceback.format_exc()}"
+                )
+                print_timestamp(
+                    f"{job.worker.user.display_name:>{job.worker.max_username_length}} | Failed to send {job.worker.trade_type} trade webhook: {job.trade['id']}"
+                )
+            finally:
+                stage.queue.task_done()
+            if passed:
+                stage.passed += 1
+                if next_stage:
+                    await next_stage.queue.put(job)
+                    continue
+            elif passed is not None:
+                stage.dropped += 1
+            job.worker.finish(job)
+
+    def collect(self):
+        """Returns metrics samples for each stage's queue depth and how many jobs it has handled"""
+        samples = []
+        for stage in self.stages:
+            samples.append(
+                ("horizon_queue_depth", {"queue": stage.name}, stage.queue.qsize())
+            )
+            for result in ("passed", "dropped", "failed"):
+                samples.append(
+                    (
+                        "horizon_pipeline_jobs_total",
+                        {"stage": stage.name, "result": result},
+                        getattr(stage, result),
+                    )
+                )
+        return samples
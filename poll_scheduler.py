@@ -0,0 +1,110 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import traceback
+
+# Local
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger("horizon.poll_scheduler")
+
+
+class PollScheduler:
+    """Runs every TradeWorker's trade checks from a single priority queue instead of one sleeping loop per worker.
+    Workers start spread evenly over their update_interval so accounts don't poll in bursts together, and every poll
+    has to fit within both a global and a per-account requests per minute budget. A poll that doesn't fit is pushed back
+    until it does. Each poll counts as one request, since the extra pages of a catch-up are rare.
+    """
+
+    def __init__(
+        self, global_requests_per_minute: int = 120, account_requests_per_minute: int = 30
+    ):
+        self.global_bucket = TokenBucket(global_requests_per_minute)
+        self.account_requests_per_minute = account_requests_per_minute
+        self.account_buckets = {}
+        self.workers = []
+        self.queue = []  # Heap of (due time, tiebreaker, worker)
+        self.counter = itertools.count()
+        self.wake = None
+        self.polls = set()  # Running poll tasks, kept so they aren't garbage collected mid-poll
+
+    def add(self, worker):
+        """Adds a TradeWorker to be polled once the scheduler runs"""
+        self.workers.append(worker)
+        if worker.user.id not in self.account_buckets:
+            self.account_buckets[worker.user.id] = TokenBucket(
+                self.account_requests_per_minute
+            )
+
+    def schedule(self, worker, due: float):
+        heapq.heappush(self.queue, (due, next(self.counter), worker))
+        if self.wake:
+            self.wake.set()
+
+    async def run(self):
+        """Polls every added worker forever"""
+        self.wake = asyncio.Event()
+        now = time.monotonic()
+        for position, worker in enumerate(self.workers):
+            self.schedule(
+                worker, now + worker.update_interval * position / len(self.workers)
+            )
+
+        while True:
+            if not self.queue:  # Every worker is mid-poll, and will be scheduled again once its poll finishes
+                self.wake.clear()
+                await self.wake.wait()
+                continue
+            due, _, worker = self.queue[0]
+            now = time.monotonic()
+            if due > now:
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), timeout=due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.queue)
+
+            account_bucket = self.account_buckets[worker.user.id]
+            delay = max(self.global_bucket.delay(), account_bucket.delay())
+            if delay > 0:
+                logger.debug(
+                    f"Delaying {worker.user.display_name} {worker.trade_type} check by {delay:.2f}s to stay within request budget"
+                )
+                self.schedule(worker, now + delay)
+                continue
+            self.global_bucket.take()
+            account_bucket.take()
+            task = asyncio.create_task(self.poll(worker))
+            self.polls.add(task)
+            task.add_done_callback(self.polls.discard)
+
+    async def poll(self, worker):
+        """Checks a worker's trades, then schedules its next check current_interval seconds later"""
+        try:
+            await worker.check_trades()
+        except Exception:
+            logger.error(
+                f"Unknown error while checking {worker.user.display_name} {worker.trade_type} trades: {traceback.format_exc()}"
+            )
+        finally:
+            self.schedule(worker, time.monotonic() + worker.current_interval)
@@ -0,0 +1,152 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import asyncio
+import logging
+import random
+import time
+
+# Third Party
+import httpx
+
+logger = logging.getLogger("horizon.rate_limiter")
+
+
+class RateLimited(Exception):
+    def __init__(self, request_url: str, attempts: int):
+        self.request_url = request_url
+        self.attempts = attempts
+        self.err = f"Gave up calling {request_url} after being rate limited {attempts} times"
+        logger.error(self.err)
+        super().__init__(self.err)
+
+
+class TokenBucket:
+    """Allows rate_per_minute actions per minute on average, with bursts of up to capacity at once"""
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else max(1, self.rate * 10)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Returns how many seconds until a token is available, 0 if one is available now"""
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """Shared rate limiting for every Roblox API call.
+    Each endpoint family (auth, users, trades, thumbnails) has a token bucket shared by all accounts, and each account
+    has its own bucket per family on top of that. When Roblox answers 429 anyway, backoff() waits for as long as the
+    response headers ask, or exponentially longer each attempt with jitter so accounts don't retry in step, and gives
+    up with RateLimited after max_retries attempts.
+    """
+
+    def __init__(
+        self,
+        family_requests_per_minute: int = 120,
+        account_requests_per_minute: int = 60,
+        max_retries: int = 5,
+        base_delay: float = 1,
+        max_delay: float = 60,
+    ):
+        self.family_requests_per_minute = family_requests_per_minute
+        self.account_requests_per_minute = account_requests_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.buckets = {}
+        self.throttled = {}  # Endpoint family: 429 responses received
+        self.throttled_seconds = 0  # Time spent waiting after 429 responses
+        self.delayed = 0  # Requests held back by a token bucket
+        self.delayed_seconds = 0  # Time spent waiting on token buckets
+
+    def bucket(self, key, rate_per_minute: int):
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(rate_per_minute)
+        return self.buckets[key]
+
+    async def acquire(self, family: str, account=None):
+        """Waits until a request to the endpoint family can be made for account within budget, and takes a token for it"""
+        buckets = [self.bucket(family, self.family_requests_per_minute)]
+        if account is not None:
+            buckets.append(
+                self.bucket((family, account), self.account_requests_per_minute)
+            )
+        waited = 0
+        while True:
+            delay = max(bucket.delay() for bucket in buckets)
+            if delay == 0:
+                break
+            waited += delay
+            await asyncio.sleep(delay)
+        for bucket in buckets:
+            bucket.take()
+        if waited:
+            self.delayed += 1
+            self.delayed_seconds += waited
+            logger.debug(f"Held back {family} request for {waited:.2f} seconds")
+
+    async def backoff(self, family: str, attempt: int, response: httpx.Response):
+        """Waits before retrying a request that got a 429 response. attempt is how many 429s this request has had so far.
+        Raises RateLimited once attempt passes max_retries.
+        """
+        self.throttled[family] = self.throttled.get(family, 0) + 1
+        if attempt > self.max_retries:
+            raise RateLimited(response.url, attempt)
+        delay = self.retry_after(response)
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+            delay = random.uniform(delay / 2, delay)
+        self.throttled_seconds += delay
+        logger.warning(
+            f"Rate limited on {family} endpoint, retrying in {delay:.2f} seconds (attempt {attempt})"
+        )
+        await asyncio.sleep(delay)
+
+    def retry_after(self, response: httpx.Response):
+        """Returns the seconds to wait from a response's Retry-After or x-ratelimit-reset header, or None if it has neither"""
+        for header in ("Retry-After", "x-ratelimit-reset"):
+            try:
+                return min(self.max_delay, max(0, float(response.headers[header])))
+            except (KeyError, ValueError):
+                continue
+        return None
+
+    def collect(self):
+        """Returns metrics samples for 429s per endpoint family and time spent throttled and delayed. 429s are also counted per account from each User."""
+        return [
+            *(
+                ("horizon_roblox_family_rate_limited_total", {"family": family}, count)
+                for family, count in self.throttled.items()
+            ),
+            ("horizon_roblox_retry_seconds_total", {}, self.throttled_seconds),
+            ("horizon_roblox_delayed_total", {}, self.delayed),
+            ("horizon_roblox_delayed_seconds_total", {}, self.delayed_seconds),
+        ]
@@ -0,0 +1,85 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import logging
+
+# Local
+from image_cache import ResizedImageCache
+from metrics import cache_samples
+from notification_builder import NotificationBuilder
+from trade_model import Trade
+
+logger = logging.getLogger("horizon.render_pool")
+
+image_cache = None  # The ResizedImageCache of the process (or render thread) running render_notification
+
+
+def initialize_renderer(image_cache_bytes: int):
+    """Sets up the image cache used by render_notification in the current process"""
+    global image_cache
+    image_cache = ResizedImageCache(max_bytes=image_cache_bytes)
+
+
+def render_notification(theme_folder: str, trade_data: Trade, asset_images: dict):
+    """Builds a notification and returns it as a RenderedImage. Runs inside the render executor.
+    Compiled themes and resized item images stay cached in the process between calls.
+    """
+    builder = NotificationBuilder.for_theme(theme_folder, image_cache=image_cache)
+    return builder.build_image(trade_data, asset_images)
+
+
+class RenderPool:
+    """Runs notification rendering outside of the event loop so polling and webhooks never wait on Pillow.
+    With processes set above 0, renders are spread over that many worker processes. With 0, they run one at a time on a background thread.
+    """
+
+    def __init__(self, processes: int = 0, image_cache_bytes: int = 64 * 1024 * 1024):
+        self.processes = processes
+        if processes > 0:
+            self.executor = ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=initialize_renderer,
+                initargs=(image_cache_bytes,),
+            )
+        else:
+            initialize_renderer(image_cache_bytes)
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        logger.info(f"Started render pool with {processes} processes")
+
+    async def render(self, theme_folder: str, trade_data: Trade, asset_images: dict):
+        """Renders a notification in the pool and returns it as a RenderedImage.
+        trade_data and asset_images are pickled to send to the worker process, which is cheap as a Trade is only nested tuples.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, render_notification, theme_folder, trade_data, asset_images
+        )
+
+    def collect(self):
+        """Returns metrics samples for the resized image cache's hit ratio.
+        With render processes each has its own cache out of reach of the main process, so there are only samples when rendering on a thread.
+        """
+        if self.processes > 0 or image_cache is None:
+            return []
+        stats = image_cache.stats()
+        return cache_samples("resized_images", stats["hits"], stats["misses"])
+
+    def shutdown(self):
+        """Shuts down the executor, waiting for any running renders to finish"""
+        self.executor.shutdown(wait=True)
+        logger.info("Shut down render pool")
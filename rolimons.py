@@ -0,0 +1,156 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+from array import array
+import asyncio
+from bisect import bisect_left
+import logging
+import time
+import traceback
+
+# Third Party
+import httpx
+
+# Local
+from utilities import get_roli_data
+
+logger = logging.getLogger("horizon.rolimons")
+
+
+class ValueIndex:
+    """Compact lookup table of rolimons value, rap and demand keyed by integer asset id.
+    Built once per refresh from the itemdetails payload, whose items look like:
+    {"assetId": [name, acronym, rap, value, default_value, demand, trend, projected, hyped, rare]}
+    The ids are stored sorted in an int array with the stats in parallel arrays, so lookups are a bisect and allocate nothing.
+    Items rolimons doesn't know about, or doesn't value, read as -1.
+    """
+
+    __slots__ = ("asset_ids", "values", "raps", "demands")
+
+    def __init__(self, roli_data: dict):
+        items = roli_data["items"]
+        asset_ids = sorted(int(asset_id) for asset_id in items)
+        self.asset_ids = array("q", asset_ids)
+        self.values = array("q", (self._stat(items[str(asset_id)], 3) for asset_id in asset_ids))
+        self.raps = array("q", (self._stat(items[str(asset_id)], 2) for asset_id in asset_ids))
+        self.demands = array("b", (self._stat(items[str(asset_id)], 5) for asset_id in asset_ids))
+
+    def __len__(self):
+        return len(self.asset_ids)
+
+    def __contains__(self, asset_id):
+        return self._position(asset_id) != -1
+
+    def value(self, asset_id) -> int:
+        """Returns the rolimons value of asset_id, or -1 if it has none"""
+        position = self._position(asset_id)
+        return self.values[position] if position != -1 else -1
+
+    def rap(self, asset_id) -> int:
+        """Returns the rolimons rap of asset_id, or -1 if it isn't tracked"""
+        position = self._position(asset_id)
+        return self.raps[position] if position != -1 else -1
+
+    def demand(self, asset_id) -> int:
+        """Returns the rolimons demand rating of asset_id, or -1 if it has none"""
+        position = self._position(asset_id)
+        return self.demands[position] if position != -1 else -1
+
+    def _position(self, asset_id) -> int:
+        asset_id = int(asset_id)
+        position = bisect_left(self.asset_ids, asset_id)
+        if position < len(self.asset_ids) and self.asset_ids[position] == asset_id:
+            return position
+        return -1
+
+    @staticmethod
+    def _stat(details: list, index: int) -> int:
+        try:
+            stat = details[index]
+        except IndexError:
+            return -1
+        return stat if isinstance(stat, int) and stat >= 0 else -1
+
+
+class RoliCache:
+    """Process-wide cache of rolimons item values shared by every TradeWorker, held as a ValueIndex.
+    The data is refreshed in the background every ttl seconds. Concurrent callers all wait on the same in-flight download,
+    and if a refresh fails the last good snapshot keeps being served.
+    """
+
+    def __init__(self, ttl: int = 300, timeout: int = 30, client: httpx.AsyncClient = None):
+        self.ttl = ttl
+        self.client = client
+        self.timeout = timeout
+        self.data = None
+        self.updated = 0
+        self._refresh_task = None
+
+    async def get(self):
+        """Returns the latest ValueIndex, waiting for the first download if nothing has been cached yet.
+        A stale snapshot is returned immediately while a refresh runs in the background.
+        """
+        if self.data is None:
+            await self.refresh()
+        elif time.monotonic() - self.updated > self.ttl:
+            self._start_refresh()
+        return self.data
+
+    async def refresh(self):
+        """Refreshes the cached data, joining the in-flight download if there is one.
+        Raises the download error only if there is no previous snapshot to fall back on.
+        """
+        try:
+            await asyncio.shield(self._start_refresh())
+        except (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.ConnectError, asyncio.TimeoutError):
+            if self.data is None:
+                raise
+            logger.warning(
+                f"Timed out while refreshing rolimons data, serving data from {int(time.monotonic() - self.updated)} seconds ago"
+            )
+        except Exception:
+            if self.data is None:
+                raise
+            logger.error(
+                f"Unknown error while refreshing rolimons data, serving previous data: {traceback.format_exc()}"
+            )
+
+    async def refresh_loop(self):
+        """Refreshes the cached data every ttl seconds"""
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.error(f"Unable to grab rolimons data: {traceback.format_exc()}")
+            await asyncio.sleep(self.ttl)
+
+    def _start_refresh(self):
+        """Starts a download if one isn't already running and returns the task for it"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch())
+            self._refresh_task.add_done_callback(self._consume_result)
+        return self._refresh_task
+
+    def _consume_result(self, task):
+        """Retrieves the result of background refreshes nobody awaited so asyncio doesn't complain about it"""
+        if not task.cancelled() and task.exception():
+            logger.debug(f"Background rolimons refresh failed: {task.exception()!r}")
+
+    async def _fetch(self):
+        roli_data = await asyncio.wait_for(get_roli_data(client=self.client), self.timeout)
+        self.data = ValueIndex(roli_data)
+        self.updated = time.monotonic()
+        logger.info("Refreshed rolimons data cache")
@@ -0,0 +1,99 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+from collections import deque
+import logging
+import os
+
+logger = logging.getLogger("horizon.seen_trades")
+
+
+class SeenTrades:
+    """Set of trade ids a TradeWorker has already handled, persisted to an append-only file so it survives restarts.
+    Only the latest window ids are kept, the oldest being forgotten first. The file is rewritten once it holds twice that many lines.
+    """
+
+    def __init__(self, path: str, window: int = 1000):
+        self.path = path
+        self.window = window
+        self.ids = set()
+        self.order = deque()
+        self.lines = 0
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.cut_off = False
+        self.loaded = self.load()
+        self.file = open(self.path, "a")
+        if self.cut_off:
+            self.compact()
+
+    def __contains__(self, trade_id):
+        return trade_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, trade_id: int):
+        """Marks trade_id as seen and appends it to the file"""
+        if trade_id in self.ids:
+            return
+        self.remember(trade_id)
+        self.file.write(f"{trade_id}\n")
+        self.file.flush()
+        self.lines += 1
+        if self.lines > self.window * 2:
+            self.compact()
+
+    def remember(self, trade_id: int):
+        """Adds trade_id to memory, forgetting the oldest ids beyond the window"""
+        self.ids.add(trade_id)
+        self.order.append(trade_id)
+        while len(self.order) > self.window:
+            self.ids.discard(self.order.popleft())
+
+    def load(self):
+        """Loads previously seen ids from the file. Returns False if there was no file to load from."""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as file:
+            for line in file:
+                self.lines += 1
+                if not line.endswith("\n"):  # A line cut off by a crash mid-write
+                    self.cut_off = True
+                    continue
+                try:
+                    trade_id = int(line)
+                except ValueError:
+                    continue
+                if trade_id not in self.ids:
+                    self.remember(trade_id)
+        logger.info(f"Loaded {len(self.ids)} seen trades from {self.path}")
+        return True
+
+    def compact(self):
+        """Rewrites the file with only the ids currently in the window"""
+        self.file.close()
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as file:
+            file.writelines(f"{trade_id}\n" for trade_id in self.order)
+        os.replace(temporary_path, self.path)
+        self.lines = len(self.order)
+        self.file = open(self.path, "a")
+        logger.debug(f"Compacted {self.path}")
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,192 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import re
+from string import Formatter
+from typing import NamedTuple
+
+# Local
+from trade_model import Item, Trade
+
+ITEM_FIELDS = {  # Template field name: Item attribute
+    "id": "id",
+    "serial_number": "serial_number",
+    "asset_id": "asset_id",
+    "name": "name",
+    "recent_average_price": "recent_average_price",
+    "original_price": "original_price",
+    "asset_stock": "asset_stock",
+    "roli_value": "value",
+}
+NUMERIC_ITEM_FIELDS = ("recent_average_price", "value")  # Shown as 0 instead of nothing for missing items
+CONVERSIONS = {"s": str, "r": repr, "a": ascii}
+FIELD_NAME = re.compile(r"[^.\[]*")
+ACCESSOR = re.compile(r"\.([^.\[]+)|\[([^\]]+)\]")
+
+
+class TradeContext:
+    """The values templates can use for one trade, such as give_rap or take_item1_name, looked up from a Trade.
+    Each value is only worked out the first time a template asks for it, and then reused by every other template
+    formatted with the same context.
+    """
+
+    __slots__ = ("trade", "values")
+
+    def __init__(self, trade: Trade):
+        self.trade = trade
+        self.values = {}
+
+    def __getitem__(self, key: str):
+        try:
+            return self.values[key]
+        except KeyError:
+            value = self.values[key] = self.lookup(key)
+            return value
+
+    def lookup(self, key: str):
+        """Works out the value of the template field key, raising KeyError for unknown fields like str.format would"""
+        if key == "" or key.isdigit():
+            raise IndexError(
+                f"Replacement index {key or 0} out of range for positional args tuple"
+            )
+        if key == "trade_status":
+            return self.trade.status
+        side_name, _, name = key.partition("_")
+        if side_name not in ("give", "take"):
+            raise KeyError(key)
+        side = getattr(self.trade, side_name)
+
+        if name == "rap":
+            return side.rap
+        elif name == "roli_value":
+            return side.value
+        elif name == "robux":
+            return str(side.robux)
+        elif name == "user_id":
+            return str(side.user_id)
+        elif name == "user_name":
+            return side.user_name
+        elif name == "user_display_name":
+            return side.user_display_name
+        elif name.startswith("item"):
+            number, _, field = name[4:].partition("_")
+            if number.isdigit() and field in ITEM_FIELDS:
+                index = int(number) - 1
+                item = side.items[index] if 0 <= index < len(side.items) else None
+                return self.item_field(item, ITEM_FIELDS[field])
+        raise KeyError(key)
+
+    def item_field(self, item: Item, field: str):
+        """Returns field of item as a string, with missing items and values shown as nothing, or 0 for prices of missing items.
+        Any item number can be used, so themes made for 4 items a side show nothing for items a trade doesn't have.
+        """
+        if item is None:
+            return "0" if field in NUMERIC_ITEM_FIELDS else ""
+        value = getattr(item, field)
+        return "" if value is None else str(value)
+
+
+class ItemContext:
+    """The values templates repeated for each item of an item grid can use.
+    item_number and item_ fields such as item_name refer to the grid's current item, and everything else is looked up in the trade's TradeContext.
+    """
+
+    __slots__ = ("context", "side", "number")
+
+    def __init__(self, context: TradeContext, side: str, number: int):
+        self.context = context
+        self.side = side
+        self.number = number
+
+    def __getitem__(self, key: str):
+        if key == "item_number":
+            return self.number
+        if key.startswith("item_") and key[5:] in ITEM_FIELDS:
+            return self.context[f"{self.side}_item{self.number}_{key[5:]}"]
+        return self.context[key]
+
+
+class Field(NamedTuple):
+    """A {replacement field} of a Template"""
+
+    name: str
+    accessors: tuple  # (is attribute, attribute name or index) for each .attribute or [index] after the name
+    conversion: str
+    format_spec: "Template"
+
+
+class Template:
+    """A format string as used in theme drawn_text and webhook_content, parsed once into literal text and fields.
+    Formatting it only looks up the fields it actually uses, giving the same result as str.format would with
+    every value of the TradeContext passed in as keyword arguments.
+    """
+
+    __slots__ = ("text", "pieces")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pieces = []  # Literal strings and Fields, in order
+        for literal, field_name, format_spec, conversion in Formatter().parse(text):
+            if literal:
+                self.pieces.append(literal)
+            if field_name is not None:
+                name, accessors = self.split_field_name(field_name)
+                self.pieces.append(
+                    Field(
+                        name,
+                        accessors,
+                        conversion,
+                        Template(format_spec) if format_spec else None,
+                    )
+                )
+
+    def split_field_name(self, field_name: str):
+        """Splits a field name like "name.attribute[index]" into its name and accessors"""
+        name = FIELD_NAME.match(field_name).group()
+        accessors = []
+        position = len(name)
+        while position < len(field_name):
+            match = ACCESSOR.match(field_name, position)
+            if match is None:
+                raise ValueError(f"Invalid field name in format string: {field_name}")
+            attribute, index = match.groups()
+            if attribute is not None:
+                accessors.append((True, attribute))
+            else:
+                accessors.append((False, int(index) if index.isdigit() else index))
+            position = match.end()
+        return name, tuple(accessors)
+
+    @property
+    def is_static(self):
+        """True if the template has no fields, so it reads the same for every trade"""
+        return all(isinstance(piece, str) for piece in self.pieces)
+
+    def format(self, context):
+        """Returns the template filled in with values from context, a TradeContext or ItemContext"""
+        parts = []
+        for piece in self.pieces:
+            if isinstance(piece, str):
+                parts.append(piece)
+                continue
+            value = context[piece.name]
+            for is_attribute, key in piece.accessors:
+                value = getattr(value, key) if is_attribute else value[key]
+            if piece.conversion:
+                value = CONVERSIONS[piece.conversion](value)
+            format_spec = piece.format_spec.format(context) if piece.format_spec else ""
+            parts.append(format(value, format_spec))
+        return "".join(parts)
@@ -0,0 +1,127 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import asyncio
+import logging
+import time
+
+# Third Party
+import httpx
+
+# Local
+from metrics import cache_samples
+from rate_limiter import RateLimiter
+from utilities import get_asset_image_url
+
+logger = logging.getLogger("horizon.thumbnail_resolver")
+
+
+class ThumbnailResolver:
+    """Resolves asset ids to thumbnail urls for every worker, batching lookups made at around the same time into shared requests.
+    Lookups are collected for window seconds, deduplicated, and sent in chunks of chunk_size, the most the thumbnails API accepts.
+    Each caller only gets back the urls it asked for. Resolved urls point at stable cdn links, so they're cached for ttl seconds.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient = None,
+        rate_limiter: RateLimiter = None,
+        window: float = 0.005,
+        chunk_size: int = 100,
+        ttl: int = 3600,
+    ):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.window = window
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.urls = {}  # (asset id, size): (url, expiry time)
+        self.pending = {}  # size: {asset id: future}
+        self.batches = set()
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, asset_ids: list, size: str = "700x700"):
+        """Returns a dict of str asset id to thumbnail url for asset_ids at size. Assets without a thumbnail available are left out."""
+        loop = asyncio.get_event_loop()
+        now = time.monotonic()
+        urls = {}
+        futures = {}
+        for asset_id in set(str(asset_id) for asset_id in asset_ids):
+            url, expiry = self.urls.get((asset_id, size), (None, 0))
+            if expiry > now:
+                self.hits += 1
+                urls[asset_id] = url
+                continue
+            self.misses += 1
+            if size not in self.pending:
+                self.pending[size] = {}
+                batch = asyncio.create_task(self.send_batch(size))
+                self.batches.add(batch)
+                batch.add_done_callback(self.batches.discard)
+            if asset_id not in self.pending[size]:
+                self.pending[size][asset_id] = loop.create_future()
+            futures[asset_id] = self.pending[size][asset_id]
+
+        results = await asyncio.gather(*futures.values())
+        for asset_id, url in zip(futures, results):
+            if url:
+                urls[asset_id] = url
+        return urls
+
+    def collect(self):
+        """Returns metrics samples for the url cache's hit ratio"""
+        return cache_samples("thumbnail_urls", self.hits, self.misses)
+
+    async def send_batch(self, size: str):
+        """Waits window seconds for lookups to collect, then resolves all of them in as few requests as possible"""
+        await asyncio.sleep(self.window)
+        pending = self.pending.pop(size)
+        asset_ids = list(pending)
+        logger.debug(f"Resolving {len(asset_ids)} thumbnail urls at {size}")
+        await asyncio.gather(
+            *(
+                self.send_chunk(asset_ids[i : i + self.chunk_size], size, pending)
+                for i in range(0, len(asset_ids), self.chunk_size)
+            )
+        )
+
+    async def send_chunk(self, asset_ids: list, size: str, pending: dict):
+        try:
+            thumbnails = await get_asset_image_url(
+                asset_ids=asset_ids,
+                size=size,
+                client=self.client,
+                rate_limiter=self.rate_limiter,
+            )
+        except Exception as e:
+            for asset_id in asset_ids:
+                pending[asset_id].set_exception(e)
+            return
+
+        expiry = time.monotonic() + self.ttl
+        for thumbnail in thumbnails["data"]:
+            asset_id = str(thumbnail["targetId"])
+            if asset_id not in pending or pending[asset_id].done():
+                continue
+            url = None
+            if thumbnail["state"] == "Completed" and thumbnail["imageUrl"]:
+                url = thumbnail["imageUrl"]
+                self.urls[(asset_id, size)] = (url, expiry)
+            pending[asset_id].set_result(url)
+        for asset_id in asset_ids:  # Anything Roblox left out of the response
+            if not pending[asset_id].done():
+                pending[asset_id].set_result(None)
@@ -0,0 +1,87 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+from typing import NamedTuple, Optional, Tuple
+
+
+class Item(NamedTuple):
+    """An item in a trade. Fields Roblox leaves out or sends as null are None."""
+
+    id: Optional[int]
+    serial_number: Optional[int]
+    asset_id: int
+    name: Optional[str]
+    recent_average_price: Optional[int]
+    original_price: Optional[int]
+    asset_stock: Optional[int]
+    roli_value: int  # The item's rolimons value, 0 if it's unvalued or missing from rolimons
+    value: Optional[int]  # roli_value, or the RAP of unvalued items when adding unvalued items to value
+
+    @classmethod
+    def from_user_asset(
+        cls, user_asset: dict, roli_value: int, add_unvalued_to_value: bool
+    ):
+        """Creates an Item from one of the userAssets of a Roblox trade offer"""
+        value = roli_value
+        if roli_value == 0 and add_unvalued_to_value:
+            value = user_asset.get("recentAveragePrice", 0)
+        return cls(
+            user_asset.get("id"),
+            user_asset.get("serialNumber"),
+            user_asset["assetId"],
+            user_asset.get("name"),
+            user_asset.get("recentAveragePrice"),
+            user_asset.get("originalPrice"),
+            user_asset.get("assetStock"),
+            roli_value,
+            value,
+        )
+
+
+class Side(NamedTuple):
+    """One user's side of a trade, with its totals worked out once when it's created"""
+
+    user_id: int
+    user_name: str
+    user_display_name: str
+    robux: int
+    items: Tuple[Item, ...]
+    rap: int
+    value: int
+
+    @classmethod
+    def from_items(cls, user: dict, robux: int, items: tuple):
+        """Creates a Side from a Roblox trade offer's user and robux, and its Items"""
+        return cls(
+            user["id"],
+            user["name"],
+            user["displayName"],
+            robux,
+            items,
+            sum(int(item.recent_average_price or 0) for item in items),
+            sum(int(item.value or 0) for item in items),
+        )
+
+
+class Trade(NamedTuple):
+    """Everything about a trade needed to build and send its notification.
+    Trades are immutable, so they can be shared between pipeline stages safely, and being tuples they're cheap to send to render processes.
+    """
+
+    id: int
+    status: str
+    give: Side
+    take: Side
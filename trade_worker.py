@@ -17,24 +17,31 @@
 import asyncio
 import logging
 import os
+import time
 import traceback
 
 # Third Party
-from discord import Webhook, File
 import httpx
 
 # Local
 from user import User
-from notification_builder import NotificationBuilder
+from rolimons import RoliCache, ValueIndex
+from http_clients import ClientRegistry
+from image_cache import ThumbnailCache
+from latency import LatencyTracker, parse_roblox_time
+from metrics import metrics
+from pipeline import Pipeline, TradeJob
+from render_pool import RenderPool
+from seen_trades import SeenTrades
+from templates import Template, TradeContext
+from rate_limiter import RateLimited
+from thumbnail_resolver import ThumbnailResolver
+from verification import VerificationQueue
+from webhook_outbox import WebhookOutbox
 from utilities import (
     print_timestamp,
-    get_roli_data,
-    get_asset_image_url,
-    get_pillow_object_from_url,
     construct_trade_data,
     UnknownResponse,
-    format_text,
-    HttpxWebhookAdapter,
 )
 
 logger = logging.getLogger("horizon.main")
@@ -49,41 +56,94 @@ class TradeWorker:
         webhook_url: str,
         update_interval: int,
         theme_name: str,
+        roli_cache: RoliCache,
+        clients: ClientRegistry,
+        thumbnails: ThumbnailCache,
+        thumbnail_resolver: ThumbnailResolver,
+        render_pool: RenderPool,
+        pipeline: Pipeline,
+        outbox: WebhookOutbox,
+        latency: LatencyTracker,
         trade_type: str = "Completed",
         add_unvalued_to_value: bool = True,
         testing: bool = False,
         double_check: bool = False,
         webhook_content: str = "",
         max_username_length: int = 20,
+        seen_trades_window: int = 1000,
+        adaptive_polling: bool = False,
+        min_update_interval: int = 10,
+        max_update_interval: int = 120,
     ):
         self = TradeWorker()
         self.main_folder_path = main_folder_path
         self.user = user
         self.webhook_url = webhook_url
         self.update_interval = update_interval
+        self.current_interval = update_interval
+        self.adaptive_polling = adaptive_polling
+        self.min_update_interval = min_update_interval
+        self.max_update_interval = max_update_interval
+        self.rate_limited = user.rate_limited
         self.theme_name = theme_name
+        self.roli_cache = roli_cache
+        self.clients = clients
+        self.thumbnails = thumbnails
+        self.thumbnail_resolver = thumbnail_resolver
+        self.render_pool = render_pool
+        self.pipeline = pipeline
+        self.outbox = outbox
+        self.latency = latency
         self.trade_type = trade_type
         self.add_unvalued_to_value = add_unvalued_to_value
-        self.double_check = double_check
-        self.webhook_content = webhook_content
+        self.verification = VerificationQueue(self) if double_check else None
+        self.webhook_template = Template(webhook_content)
         self.max_username_length = max_username_length
+        self.metric_labels = {"account": self.user.display_name, "trade_type": trade_type}
 
-        self.old_trades = []
-        self.roli_data = None
-        old_trade_info = await self.user.get_trade_status_info(
-            tradeStatusType=self.trade_type, limit=25
+        themes_folder = os.path.join(self.main_folder_path, "themes")
+        self.theme_folder = os.path.join(themes_folder, self.theme_name)
+
+        self.value_index = None
+        self.seen_trades = SeenTrades(
+            os.path.join(
+                self.main_folder_path,
+                "data",
+                "seen_trades",
+                f"{self.user.id}_{self.trade_type}.txt",
+            ),
+            window=seen_trades_window,
         )
-        for trade in old_trade_info["data"][
-            ::-1
-        ]:  # ::-1 to put old trades first in list, which are first to be removed
-            self.old_trades.append(trade["id"])
+        self.in_flight = set()  # Trades detected but not yet in the outbox. They're only saved as seen once finished, so a restart picks them up again.
+        if (
+            not self.seen_trades.loaded or testing
+        ):  # Seen trades from a previous run are already on disk, so history is only needed on first run or to test with
+            while True:
+                try:
+                    old_trade_info = await self.user.get_trade_status_info(
+                        tradeStatusType=self.trade_type, limit=25
+                    )
+                    break
+                except RateLimited:
+                    print_timestamp(
+                        f"{self.user.display_name:>{self.max_username_length}} | Rate limited while grabbing {self.trade_type} trade history, retrying in {self.user.rate_limiter.max_delay:.0f} seconds"
+                    )
+                    await asyncio.sleep(self.user.rate_limiter.max_delay)
+        self.catching_up = (
+            self.seen_trades.loaded
+        )  # Trades may have come in while Horizon was closed, so the first check pages through with the bigger limit
+        if not self.seen_trades.loaded:
+            for trade in old_trade_info["data"][
+                ::-1
+            ]:  # ::-1 to put old trades first in the window, which are first to be removed
+                self.seen_trades.add(trade["id"])
 
         if testing:
             print_timestamp(
                 f"{self.user.display_name:>{self.max_username_length}} | {self.trade_type} testing mode enabled"
             )
             try:
-                asyncio.create_task(self.send_trade(old_trade_info["data"][0]))
+                await self.pipeline.submit(TradeJob(self, old_trade_info["data"][0]))
             except IndexError:
                 logger.warning(
                     f"{self.user.display_name:>{self.max_username_length}} | No {self.trade_type} trades in history to send test webhook based on"
@@ -93,35 +153,12 @@ class TradeWorker:
                 )
         return self
 
-    async def send_trade(self, trade):
-        if self.double_check:
-            print_timestamp(
-                f"{self.user.display_name:>{self.max_username_length}} | Double-checking {self.trade_type} trade: {trade['id']}"
-            )
-            await asyncio.sleep(10)
-            while True:
-                try:
-                    trades_info = await self.user.get_trade_status_info(
-                        tradeStatusType=self.trade_type
-                    )
-                    break
-                except (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.ConnectError):
-                    logger.warning(
-                        f"{self.user.display_name:>{self.max_username_length}} | Timed out while trying to grab {self.trade_type} trade status info: {traceback.format_exc()}"
-                    )
-                    print_timestamp(
-                        f"{self.user.display_name:>{self.max_username_length}} | Timed out while trying to grab {self.trade_type} trade status info"
-                    )
-                    await asyncio.sleep(5)
-            if trade["id"] not in [trade["id"] for trade in trades_info["data"][::-1]]:
-                print_timestamp(
-                    f"{self.user.display_name:>{self.max_username_length}} | {self.trade_type} trade {trade['id']} detected as fake, skipping notification"
-                )
-                return
-
+    async def enrich(self, job: TradeJob):
+        """Pipeline stage. Grabs the trade's details and builds its Trade with item values."""
         try:
-            self.roli_data = await get_roli_data()
-        except httpx.ReadTimeout:
+            with self.stage_timer("values"):
+                self.value_index = await self.roli_cache.get()
+        except (httpx.ConnectTimeout, httpx.ReadTimeout, asyncio.TimeoutError):
             logger.error(
                 f"{self.user.display_name:>{self.max_username_length}} | Timed out while trying to grab roli data: {traceback.format_exc()}"
             )
@@ -132,81 +169,219 @@ class TradeWorker:
             logger.error(
                 f"{self.user.display_name:>{self.max_username_length}} | Unknown error while grabbing rolimons data: {traceback.format_exc()}"
             )
+        if self.value_index is None:  # Rolimons has never answered, so send the trade with every item unvalued rather than not at all
+            self.value_index = ValueIndex({"items": {}})
 
-        trade_info = await self.user.get_trade_info(trade["id"])
-        trade_data = construct_trade_data(
+        while True:
+            try:
+                with self.stage_timer("trade_info"):
+                    trade_info = await self.user.get_trade_info(job.trade["id"])
+                break
+            except RateLimited:  # Under sustained 429s, wait rather than lose the trade
+                print_timestamp(
+                    f"{self.user.display_name:>{self.max_username_length}} | Rate limited while grabbing {self.trade_type} trade {job.trade['id']}, retrying in {self.user.rate_limiter.max_delay:.0f} seconds"
+                )
+                await asyncio.sleep(self.user.rate_limiter.max_delay)
+        job.trade_data = construct_trade_data(
             trade_info,
-            self.roli_data,
+            self.value_index,
             self.user.id,
             self.add_unvalued_to_value,
             self.trade_type,
         )
+        return True
 
+    async def fetch_images(self, job: TradeJob):
+        """Pipeline stage. Gets the thumbnail of every item in the trade, from the thumbnail cache or else downloaded."""
         asset_ids = []
-        for offer in (trade_data["give"], trade_data["take"]):
-            for item in offer["items"].values():
-                if str(item["assetId"]) not in asset_ids:
-                    asset_ids.append(str(item["assetId"]))
+        for side in (job.trade_data.give, job.trade_data.take):
+            for item in side.items:
+                if str(item.asset_id) not in asset_ids:
+                    asset_ids.append(str(item.asset_id))
 
+        size = "700x700"
         asset_images = {}
-        asset_image_urls = await get_asset_image_url(
-            asset_ids=asset_ids, size="700x700"
+        uncached_asset_ids = []
+        for asset_id in asset_ids:
+            image_bytes = self.thumbnails.get(asset_id, size)
+            if image_bytes is None:
+                uncached_asset_ids.append(asset_id)
+            else:
+                asset_images[asset_id] = image_bytes
+        if uncached_asset_ids:
+            with self.stage_timer("thumbnail_urls"):
+                asset_image_urls = await self.thumbnail_resolver.resolve(
+                    uncached_asset_ids, size=size
+                )
+            with self.stage_timer("image_download"):
+                asset_images.update(
+                    await self.thumbnails.download(
+                        asset_image_urls, size, client=self.clients.get("rbxcdn")
+                    )
+                )
+        for asset_id in asset_ids:
+            if asset_id not in asset_images:
+                logger.warning(
+                    f"{self.user.display_name:>{self.max_username_length}} | No thumbnail available for asset {asset_id}"
+                )
+        job.asset_images = asset_images
+        return True
+
+    async def render(self, job: TradeJob):
+        """Pipeline stage. Builds the notification image in the render pool."""
+        job.rendered = await self.render_pool.render(
+            self.theme_folder, job.trade_data, job.asset_images
         )
-        for item in asset_image_urls["data"]:
-            asset_images[str(item["targetId"])] = await get_pillow_object_from_url(
-                item["imageUrl"]
-            )
-        for offer in (trade_data["give"], trade_data["take"]):
-            for item in offer["items"].values():
-                item["pillowImage"] = asset_images[str(item["assetId"])]
+        job.rendered_at = time.time()
+        metrics.observe(
+            "horizon_stage_seconds",
+            job.rendered.render_seconds,
+            stage="render",
+            **self.metric_labels,
+        )
+        metrics.observe(
+            "horizon_stage_seconds",
+            job.rendered.encode_seconds,
+            stage="encode",
+            **self.metric_labels,
+        )
+        logger.debug(
+            f"{self.user.display_name:>{self.max_username_length}} | Rendered {self.trade_type} trade {job.trade['id']} in {job.rendered.render_seconds * 1000:.0f}ms, encoded {len(job.rendered.data)} bytes of {job.rendered.file_extension} in {job.rendered.encode_seconds * 1000:.0f}ms"
+        )
+        return True
 
-        themes_folder = os.path.join(self.main_folder_path, "themes")
-        theme_folder = os.path.join(themes_folder, self.theme_name)
-        builder = NotificationBuilder(theme_folder)
-        image_bytes = builder.build_image(trade_data)
-        content = format_text(self.webhook_content, trade_data)
-
-        async with httpx.AsyncClient() as client:
-            webhook = Webhook.from_url(
-                self.webhook_url, adapter=HttpxWebhookAdapter(client)
+    async def deliver(self, job: TradeJob):
+        """Pipeline stage. Saves the notification to the outbox, which sends it to the webhook as soon as discord's rate limit allows."""
+        queued = time.perf_counter()
+
+        def on_sent():
+            metrics.observe(
+                "horizon_stage_seconds",
+                time.perf_counter() - queued,
+                stage="delivery",
+                **self.metric_labels,
             )
-            await webhook.send(
-                content=content,
-                file=File(image_bytes, filename="trade.png"),
+            self.latency.record(
+                self.trade_type,
+                parse_roblox_time(job.trade.get("created")),
+                job.detected_at,
+                job.rendered_at,
+                time.time(),
             )
-        logger.info(
-            f"{self.user.display_name:>{self.max_username_length}} | Sent {self.trade_type} trade webhook: {trade['id']}"
+
+        await self.outbox.put(
+            self.webhook_url,
+            self.webhook_template.format(TradeContext(job.trade_data)),
+            f"trade.{job.rendered.file_extension}",
+            job.rendered.data,
+            name=f"{self.user.display_name:>{self.max_username_length}}",
+            description=f"{self.trade_type} trade webhook: {job.trade['id']}",
+            on_sent=on_sent,
         )
+        return True
+
+    async def check_trades(self):
+        """Checks for new trades once and submits each to the pipeline to be notified. Called by the PollScheduler every current_interval seconds.
+        Waits while the pipeline is full, which holds back this worker's next check until it catches up.
+        """
         print_timestamp(
-            f"{self.user.display_name:>{self.max_username_length}} | Sent {self.trade_type} trade webhook: {trade['id']}"
+            f"{self.user.display_name:>{self.max_username_length}} | Checking {self.trade_type} trades"
         )
+        try:
+            with self.stage_timer("poll"):
+                new_trades = await self.get_new_trades()
+        except (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.ConnectError):
+            logger.warning(
+                f"{self.user.display_name:>{self.max_username_length}} | Timed out while trying to grab {self.trade_type} trade status info: {traceback.format_exc()}"
+            )
+            print_timestamp(
+                f"{self.user.display_name:>{self.max_username_length}} | Timed out while trying to grab {self.trade_type} trade status info"
+            )
+            return
+        except RateLimited:
+            print_timestamp(
+                f"{self.user.display_name:>{self.max_username_length}} | Rate limited too many times while trying to grab {self.trade_type} trade status info"
+            )
+            self.adapt_interval(False)
+            return
 
-    async def check_trade_loop(self):
-        while True:
+        self.adapt_interval(bool(new_trades))
+        for trade in new_trades:
             print_timestamp(
-                f"{self.user.display_name:>{self.max_username_length}} | Checking {self.trade_type} trades"
+                f"{self.user.display_name:>{self.max_username_length}} | Detected new {self.trade_type} trade: {trade['id']}"
             )
-            try:
-                trades_info = await self.user.get_trade_status_info(
-                    tradeStatusType=self.trade_type
-                )
-            except (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.ConnectError):
-                logger.warning(
-                    f"{self.user.display_name:>{self.max_username_length}} | Timed out while trying to grab {self.trade_type} trade status info: {traceback.format_exc()}"
-                )
-                print_timestamp(
-                    f"{self.user.display_name:>{self.max_username_length}} | Timed out while trying to grab {self.trade_type} trade status info"
-                )
-                await asyncio.sleep(self.update_interval)
-                continue
+            self.in_flight.add(trade["id"])
+            metrics.increment("horizon_trades_detected_total", **self.metric_labels)
+            if self.verification:
+                self.verification.add(TradeJob(self, trade))
+            else:
+                await self.pipeline.submit(TradeJob(self, trade))
 
-            for trade in trades_info["data"][::-1]:
-                if trade["id"] not in self.old_trades:
-                    print_timestamp(
-                        f"{self.user.display_name:>{self.max_username_length}} | Detected new {self.trade_type} trade: {trade['id']}"
-                    )
-                    self.old_trades.append(trade["id"])
-                    if len(self.old_trades) > 25:
-                        del self.old_trades[0:-25]
-                    asyncio.create_task(self.send_trade(trade))
-            await asyncio.sleep(self.update_interval)
\ No newline at end of file
+    def finish(self, job: TradeJob):
+        """Saves a trade as seen once its notification is stored in the outbox, or it's been dropped or failed for good"""
+        self.in_flight.discard(job.trade["id"])
+        self.seen_trades.add(job.trade["id"])
+
+    def stage_timer(self, stage: str):
+        """Returns a context manager recording how long its block takes as stage of this worker's trades"""
+        return metrics.timer("horizon_stage_seconds", stage=stage, **self.metric_labels)
+
+    def collect(self):
+        """Returns metrics samples for how many trades are waiting to be double-checked"""
+        if not self.verification:
+            return []
+        return [
+            (
+                "horizon_queue_depth",
+                {"queue": "verification", **self.metric_labels},
+                len(self.verification.pending),
+            )
+        ]
+
+    def adapt_interval(self, found_trades: bool):
+        """With adaptive polling, drops current_interval to min_update_interval after new trades are found, and otherwise backs off by half again
+        each check up to max_update_interval. Any 429 responses since the last check double the interval, even during activity.
+        """
+        if not self.adaptive_polling:
+            return
+        if found_trades:
+            interval = self.min_update_interval
+        else:
+            interval = self.current_interval * 1.5
+        if self.user.rate_limited > self.rate_limited:
+            self.rate_limited = self.user.rate_limited
+            interval = max(interval, self.current_interval) * 2
+        interval = min(max(interval, self.min_update_interval), self.max_update_interval)
+        if interval != self.current_interval:
+            logger.debug(
+                f"{self.user.display_name:>{self.max_username_length}} | {self.trade_type} check interval changed to {interval:.0f} seconds"
+            )
+        self.current_interval = interval
+
+    async def get_new_trades(self):
+        """Pages through the trade list until reaching a page with a trade that's already been seen, and returns every unseen trade, oldest first.
+        The rest of that page is still checked, since an older trade can complete after a newer one. Normally a single 10 trade page covers everything new. If a whole page is new, a burst of trades has come in and
+        the list is paged through again with 100 trades per page, which is also done straight after startup.
+        """
+        limit = 100 if self.catching_up else 10
+        new_trades = []
+        async for page in self.user.iter_trade_status_pages(
+            tradeStatusType=self.trade_type, limit=limit
+        ):
+            reached_seen = False
+            for trade in page["data"]:
+                if trade["id"] in self.seen_trades or trade["id"] in self.in_flight:
+                    reached_seen = True
+                else:
+                    new_trades.append(trade)
+            if reached_seen:
+                self.catching_up = False
+                return new_trades[::-1]
+            if limit == 10 and page.get("nextPageCursor"):
+                logger.info(
+                    f"{self.user.display_name:>{self.max_username_length}} | More than {limit} new {self.trade_type} trades, catching up"
+                )
+                self.catching_up = True
+                return await self.get_new_trades()
+        self.catching_up = False
+        return new_trades[::-1]
\ No newline at end of file
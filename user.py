@@ -14,13 +14,13 @@
 
 
 # Standard Library
-import asyncio
 import logging
 
 # Third-Party
 import httpx
 
 # Local
+from rate_limiter import RateLimiter
 from utilities import UnknownResponse, InvalidCookie
 
 logger = logging.getLogger("horizon.user")
@@ -28,21 +28,29 @@ logger = logging.getLogger("horizon.user")
 
 class User:
     @classmethod
-    async def create(cls, security_cookie):
+    async def create(cls, security_cookie, clients=None, rate_limiter: RateLimiter = None):
         """Factory method to allow for async initialization of User object.
         security_cookie should be formatted as: "_|WARNING:-DO-NOT-SHARE-THIS.--Sharing-this-will-allow-someone-to-log-in-as-you-and-to-steal-your-ROBUX-and-items.|_xyz123"
+        clients should be the ClientRegistry whose pool settings the user's own client is created with, or None for httpx defaults
+        rate_limiter should be the RateLimiter shared by every user, or None to give this user one of its own
         Returns a User() object with a loaded up csrf token and id.
         """
         logger.debug("Creating user object")
         self = User()
-        self.client = httpx.AsyncClient(cookies={})
+        self.rate_limited = 0  # How many 429 responses this user has received, read by TradeWorker to back off
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.rate_limit_key = id(self)  # Identifies this cookie's own buckets in the rate limiter
+        if clients:
+            self.client = clients.create_client(cookies={})
+        else:
+            self.client = httpx.AsyncClient(cookies={})
         self.client.cookies[".ROBLOSECURITY"] = security_cookie
         try:
             await self.update_csrf()
-        except InvalidCookie as e:
+            await self.update_user_info()
+        except Exception:  # Such as InvalidCookie or RateLimited, which main retries with a new User
             await self.client.aclose()
-            raise (e)
-        await self.update_user_info()
+            raise
         logger.info("Created user object")
         return self
 
@@ -50,8 +58,10 @@ class User:
         """Updates the self.client x-csrf-token cookie (in reality is a header but passed in as a cookie to roblox works)
         Returns None
         """
+        rate_limit_attempt = 0
         while True:
             logger.debug("Updating user x-csrf-token")
+            await self.rate_limiter.acquire("auth", self.rate_limit_key)
             request = await self.client.post("https://auth.roblox.com/v1/logout")
             try:
                 self.client.cookies["X-CSRF-TOKEN"] = request.headers["x-csrf-token"]
@@ -59,7 +69,9 @@ class User:
                 return
             except KeyError:
                 if request.status_code == 429:
-                    await asyncio.sleep(5)
+                    self.rate_limited += 1
+                    rate_limit_attempt += 1
+                    await self.rate_limiter.backoff("auth", rate_limit_attempt, request)
                     continue
                 if request.status_code == 401:
                     raise InvalidCookie(
@@ -77,8 +89,10 @@ class User:
         """Updates self.id to integer id of roblox account tied to the security_cookie passed in on class creation.
         Returns None
         """
+        rate_limit_attempt = 0
         while True:
             logger.debug("Updating user info")
+            await self.rate_limiter.acquire("users", self.rate_limit_key)
             request = await self.client.get(
                 "https://users.roblox.com/v1/users/authenticated"
             )
@@ -90,7 +104,9 @@ class User:
                 logger.info("Updated user info")
                 return
             elif request.status_code == 429:
-                await asyncio.sleep(5)
+                self.rate_limited += 1
+                rate_limit_attempt += 1
+                await self.rate_limiter.backoff("users", rate_limit_attempt, request)
                 continue
             else:
                 raise UnknownResponse(
@@ -98,12 +114,17 @@ class User:
                 )
 
     async def get_trade_status_info(
-        self, tradeStatusType: str = "Inbound", limit: int = 10, sortOrder: str = "Asc"
+        self,
+        tradeStatusType: str = "Inbound",
+        limit: int = 10,
+        sortOrder: str = "Asc",
+        cursor: str = None,
     ):
         """Grabs general details about a certain trade type.
         tradeStatusType can be Inbound, Outbound, or Completed
         limit can be 10, 25, or 100 as per Roblox API
         sortOrder can be Asc or Desc, but it seems to make no difference
+        cursor can be the nextPageCursor of a previous call to grab the page after it
         Returns a dict:
         {
         "previousPageCursor": "string",
@@ -125,17 +146,23 @@ class User:
         }
         """
         attempt = 0
+        rate_limit_attempt = 0
         while True:
             logger.debug(f"Grabbing user trade status info {tradeStatusType}")
-            request = await self.client.get(
-                f"https://trades.roblox.com/v1/trades/{tradeStatusType}?limit={limit}&sortOrder={sortOrder}"
-            )
+            url = f"https://trades.roblox.com/v1/trades/{tradeStatusType}"
+            params = {"limit": limit, "sortOrder": sortOrder}
+            if cursor:
+                params["cursor"] = cursor
+            await self.rate_limiter.acquire("trades", self.rate_limit_key)
+            request = await self.client.get(url, params=params)
             if request.status_code == 200:
                 request_json = request.json()
                 logger.debug(f"Grabbed user trade status info {tradeStatusType}")
                 return request_json
             if request.status_code == 429:
-                await asyncio.sleep(5)
+                self.rate_limited += 1
+                rate_limit_attempt += 1
+                await self.rate_limiter.backoff("trades", rate_limit_attempt, request)
                 continue
             else:
                 attempt += 1
@@ -147,6 +174,25 @@ class User:
                     await self.update_csrf()
                     continue
 
+    async def iter_trade_status_pages(
+        self, tradeStatusType: str = "Inbound", limit: int = 10, sortOrder: str = "Asc"
+    ):
+        """Async generator yielding every page of get_trade_status_info for a trade type, newest trades first, following nextPageCursor.
+        Stop iterating once you've found what you need to avoid requesting pages you don't.
+        """
+        cursor = None
+        while True:
+            page = await self.get_trade_status_info(
+                tradeStatusType=tradeStatusType,
+                limit=limit,
+                sortOrder=sortOrder,
+                cursor=cursor,
+            )
+            yield page
+            cursor = page.get("nextPageCursor")
+            if not cursor:
+                return
+
     async def get_trade_info(self, trade_id: int):
         """Grabs details about a specific trade id
         trade_id must be an integer id of a trade the account the class is tied to has access to
@@ -187,8 +233,10 @@ class User:
         }
         """
         attempt = 0
+        rate_limit_attempt = 0
         while True:
             logger.debug("Grabbing user trade info")
+            await self.rate_limiter.acquire("trades", self.rate_limit_key)
             request = await self.client.get(
                 f"https://trades.roblox.com/v1/trades/{trade_id}"
             )
@@ -197,7 +245,9 @@ class User:
                 logger.debug(f"Grabbed user trade info {trade_id}")
                 return request_json
             if request.status_code == 429:
-                await asyncio.sleep(5)
+                self.rate_limited += 1
+                rate_limit_attempt += 1
+                await self.rate_limiter.backoff("trades", rate_limit_attempt, request)
                 continue
             else:
                 attempt += 1
@@ -16,15 +16,19 @@
 # Standard Library
 import asyncio
 from configparser import ConfigParser
+from contextlib import asynccontextmanager
 import logging
 import os
 import time
 
 # Third-Party
 from discord import webhook, Webhook, Embed, utils
-from PIL import Image  # Pillow
 import httpx
 
+# Local
+from rate_limiter import RateLimiter
+from trade_model import Item, Side, Trade
+
 logger = logging.getLogger("horizon.utilities")
 
 
@@ -60,17 +64,31 @@ def print_timestamp(text: str):
     print(time.strftime("%H:%M:%S | ", time.localtime()) + text)
 
 
+@asynccontextmanager
+async def client_or_temporary(client: httpx.AsyncClient = None):
+    """Yields the provided pooled client untouched, or a temporary client that is closed on exit if client is None"""
+    if client is not None:
+        yield client
+        return
+    async with httpx.AsyncClient() as temporary_client:
+        yield temporary_client
+
+
 async def get_asset_image_url(
     asset_ids: list,
     format: str = "Png",
     isCircular: str = "false",
     size: str = "110x110",
+    client: httpx.AsyncClient = None,
+    rate_limiter=None,
 ):
     """Grabs asset image urls from roblox using provided asset ids
     asset_ids should be a list of integer roblox asset ids
     format should be string either Png or Jpeg depending on if you want opacity or not
     isCircular should be a string either true or false no capitals based on if you want the image to be circular or not
     size should be a string and a size roblox supports. use google to find these or look here: https://thumbnails.roblox.com/docs#!/Assets/get_v1_assets
+    client should be the pooled thumbnails client, or None to use a temporary one
+    rate_limiter should be the shared RateLimiter, or None to only back off on 429 responses without a request budget
     Returns a dict:
     {
     "data": [
@@ -82,9 +100,12 @@ async def get_asset_image_url(
     ]
     }
     """
-    async with httpx.AsyncClient() as client:
+    rate_limiter = rate_limiter or RateLimiter()
+    attempt = 0
+    async with client_or_temporary(client) as client:
         while True:
             logger.debug("Grabbing asset image urls")
+            await rate_limiter.acquire("thumbnails")
             request = await client.get(
                 f"https://thumbnails.roblox.com/v1/assets?assetIds={',+'.join(asset_ids)}&format={format}&isCircular={isCircular}&size={size}"
             )
@@ -93,7 +114,8 @@ async def get_asset_image_url(
                 logger.info("Grabbed asset image urls")
                 return request_json
             if request.status_code == 429:
-                await asyncio.sleep(5)
+                attempt += 1
+                await rate_limiter.backoff("thumbnails", attempt, request)
                 continue
             else:
                 raise UnknownResponse(
@@ -101,16 +123,15 @@ async def get_asset_image_url(
                 )
 
 
-async def get_pillow_object_from_url(url: str):
-    """Takes a url string containing an image and returns a pillow Image object"""
-    async with httpx.AsyncClient() as client:
+async def get_image_bytes_from_url(url: str, client: httpx.AsyncClient = None):
+    """Takes a url string containing an image and returns the raw image bytes"""
+    async with client_or_temporary(client) as client:
         while True:
-            logger.debug(f"Creating pillow Image object from url {url}")
+            logger.debug(f"Downloading image from url {url}")
             request = await client.get(url)
             if request.status_code == 200:
-                p_obj = Image.open(request)
-                logger.info(f"Created pillow Image object from url: {url}")
-                return p_obj
+                logger.info(f"Downloaded image from url: {url}")
+                return request.content
             if request.status_code == 429:
                 await asyncio.sleep(5)
                 continue
@@ -121,7 +142,10 @@ async def get_pillow_object_from_url(url: str):
 
 
 async def send_trade_webhook(
-    webhook_url: str, content: str = "", attachments: list = None
+    webhook_url: str,
+    content: str = "",
+    attachments: list = None,
+    client: httpx.AsyncClient = None,
 ):
     """Sends a webhook to the provided url with the content and attachments provided
     webhook_url must be a string
@@ -131,7 +155,7 @@ async def send_trade_webhook(
     files = {}
     for i in range(len(attachments)):
         files[f"file_{i}"] = (attachments[i][0], attachments[i][1])
-    async with httpx.AsyncClient() as client:
+    async with client_or_temporary(client) as client:
         logger.debug("Sending trade webhook")
         request = await client.post(
             webhook_url, data={"content": content[:2000]}, files=files
@@ -145,9 +169,9 @@ async def send_trade_webhook(
         )
 
 
-async def get_roli_data():
+async def get_roli_data(client: httpx.AsyncClient = None):
     """Grabs rolimons itemdetails data and returns it as a dict"""
-    async with httpx.AsyncClient() as client:
+    async with client_or_temporary(client) as client:
         logger.debug("Getting rolimon's data")
         request = await client.get("https://www.rolimons.com/itemapi/itemdetails")
     if request.status_code == 200:
@@ -225,6 +249,88 @@ def load_config(path: str):
     config["outbound"]["theme_name"] = parser["OUTBOUND"]["theme_name"]
     config["outbound"]["webhook_content"] = parser["OUTBOUND"]["webhook_content"]
 
+    if not parser.has_section("PERFORMANCE"):
+        parser.add_section("PERFORMANCE")
+    config["roli_data_ttl"] = int(parser["PERFORMANCE"].get("roli_data_ttl", "300"))
+    config["max_connections"] = int(
+        parser["PERFORMANCE"].get("max_connections", "20")
+    )
+    config["max_keepalive_connections"] = int(
+        parser["PERFORMANCE"].get("max_keepalive_connections", "10")
+    )
+    config["max_concurrent_downloads"] = int(
+        parser["PERFORMANCE"].get("max_concurrent_downloads", "8")
+    )
+    config["thumbnail_batch_window_ms"] = int(
+        parser["PERFORMANCE"].get("thumbnail_batch_window_ms", "5")
+    )
+    config["thumbnail_url_ttl"] = int(
+        parser["PERFORMANCE"].get("thumbnail_url_ttl", "3600")
+    )
+    config["mmap_thumbnail_cache"] = (
+        True
+        if str(parser["PERFORMANCE"].get("mmap_thumbnail_cache", "False")).upper()
+        == "TRUE"
+        else False
+    )
+    config["image_cache_size_mb"] = int(
+        parser["PERFORMANCE"].get("image_cache_size_mb", "64")
+    )
+    config["render_processes"] = int(
+        parser["PERFORMANCE"].get("render_processes", "0")
+    )
+    config["pipeline_queue_size"] = int(
+        parser["PERFORMANCE"].get("pipeline_queue_size", "100")
+    )
+    config["enrich_workers"] = int(parser["PERFORMANCE"].get("enrich_workers", "4"))
+    config["image_workers"] = int(parser["PERFORMANCE"].get("image_workers", "4"))
+    config["render_workers"] = int(parser["PERFORMANCE"].get("render_workers", "0"))
+    config["deliver_workers"] = int(parser["PERFORMANCE"].get("deliver_workers", "2"))
+    config["coalesce_notifications"] = (
+        True
+        if str(parser["PERFORMANCE"].get("coalesce_notifications", "False")).upper()
+        == "TRUE"
+        else False
+    )
+    config["coalesce_window"] = float(
+        parser["PERFORMANCE"].get("coalesce_window", "2")
+    )
+    config["seen_trades_window"] = int(
+        parser["PERFORMANCE"].get("seen_trades_window", "1000")
+    )
+    config["global_requests_per_minute"] = int(
+        parser["PERFORMANCE"].get("global_requests_per_minute", "120")
+    )
+    config["account_requests_per_minute"] = int(
+        parser["PERFORMANCE"].get("account_requests_per_minute", "30")
+    )
+    config["family_requests_per_minute"] = int(
+        parser["PERFORMANCE"].get("family_requests_per_minute", "120")
+    )
+    config["cookie_requests_per_minute"] = int(
+        parser["PERFORMANCE"].get("cookie_requests_per_minute", "60")
+    )
+    config["max_rate_limit_retries"] = int(
+        parser["PERFORMANCE"].get("max_rate_limit_retries", "5")
+    )
+    config["adaptive_polling"] = (
+        True
+        if str(parser["PERFORMANCE"].get("adaptive_polling", "False")).upper()
+        == "TRUE"
+        else False
+    )
+    config["min_update_interval"] = int(
+        parser["PERFORMANCE"].get("min_update_interval", "10")
+    )
+    config["max_update_interval"] = int(
+        parser["PERFORMANCE"].get("max_update_interval", "120")
+    )
+    config["http2"] = (
+        True
+        if str(parser["PERFORMANCE"].get("http2", "False")).upper() == "TRUE"
+        else False
+    )
+
     config["logging_level"] = int(parser["DEBUG"]["logging_level"])
     config["testing"] = (
         True if str(parser["DEBUG"]["testing"]).upper() == "TRUE" else False
@@ -232,260 +338,60 @@ def load_config(path: str):
     config["check_for_update"] = (
         True if str(parser["DEBUG"]["check_for_update"]).upper() == "TRUE" else False
     )
+    config["metrics_port"] = int(parser["DEBUG"].get("metrics_port", "0"))
+    config["latency_stats_interval"] = float(
+        parser["DEBUG"].get("latency_stats_interval", "300")
+    )
+    config["latency_window"] = int(parser["DEBUG"].get("latency_window", "1000"))
+    config["latency_console"] = (
+        True
+        if str(parser["DEBUG"].get("latency_console", "False")).upper() == "TRUE"
+        else False
+    )
 
     return config
 
 
 def construct_trade_data(
     trade_info: dict,
-    roli_data: dict,
+    value_index,
     user_id: int,
     add_unvalued_to_value: bool,
     trade_status: str,
 ):
-    """Inputs roblox trade data, rolimons data, 'self' user_id to mark one of the trade info people as user, and unvalued to value
-    Outputs completely generated trade_data WITHOUT pillow images. After adding pillow images, ready to pass into NotificationBuilder
+    """Inputs roblox trade data, a rolimons ValueIndex, 'self' user_id to mark one of the trade info people as user, and unvalued to value
+    Items missing from the ValueIndex are given a roli_value of 0, same as unvalued items.
+    Outputs a Trade, ready to pass into NotificationBuilder along with the item thumbnails
     """
-    trade_data = {}
-    trade_data["addUnvaluedToValue"] = add_unvalued_to_value
-    trade_data["status"] = trade_status.lower().capitalize()
-    trade_data["give"] = {}
-    trade_data["take"] = {}
-
+    sides = {}
     for offer in trade_info["offers"]:
         side = "give"
         if offer["user"]["id"] != user_id:
             side = "take"
 
-        trade_data[side]["user"] = offer["user"]
-
-        trade_data[side]["items"] = {}
-        for item_num in range(len(offer["userAssets"])):
-            trade_data[side]["items"][
-                f"item{item_num+1}"
-            ] = {}  # Add + 1 so counting starts from 1 for user convenience
-
-            for key, value in offer["userAssets"][item_num].items():
-                trade_data[side]["items"][f"item{item_num+1}"][key] = value
-
+        items = []
+        for user_asset in offer["userAssets"]:
             value = 0
-            item_id = str(offer["userAssets"][item_num]["assetId"])
-            if roli_data["items"][item_id][3] > 0:
-                value = roli_data["items"][item_id][3]
-            trade_data[side]["items"][f"item{item_num+1}"]["roliValue"] = value
-
-        trade_data[side]["robux"] = offer["robux"]
-
-    return trade_data
+            item_id = user_asset["assetId"]
+            if value_index.value(item_id) > 0:
+                value = value_index.value(item_id)
+            elif item_id not in value_index:
+                logger.debug(f"Asset {item_id} is missing from rolimons data")
+            items.append(Item.from_user_asset(user_asset, value, add_unvalued_to_value))
+
+        sides[side] = Side.from_items(offer["user"], offer["robux"], tuple(items))
+
+    return Trade(
+        trade_info.get("id"),
+        trade_status.lower().capitalize(),
+        sides["give"],
+        sides["take"],
+    )
 
 
-def format_text(text: str, trade_data: dict):
-    """Formats different keywords for text stitching
-    text is the string that needs formatting
-    trade_data is a trade_data generated from construct_trade_data to use the details to format with
-    Returns a formatted version of text
-    """
-    item_filter = ["item2", "item3", "item4"]
-    var_filter = [
-        "id",
-        "serialNumber",
-        "assetId",
-        "name",
-        "originalPrice",
-        "assetStock",
-    ]
-    for side in ("give", "take"):
-        for item in trade_data[side]["items"]:
-            for key, value in trade_data[side]["items"][
-                item
-            ].items():  # Changing NoneTypes to empty strings so they show up as nothing on notification.
-                if value == None:
-                    trade_data[side]["items"][item][key] = ""
-            if trade_data["addUnvaluedToValue"]:
-                if trade_data[side]["items"][item]["roliValue"] == 0:
-                    trade_data[side]["items"][item]["roliValue"] = trade_data[side][
-                        "items"
-                    ][item]["recentAveragePrice"]
-        for (
-            x
-        ) in (
-            item_filter
-        ):  # Adding all items to dict so .format below doesn't scream IndexError. Can't just try/except it because then it won't work. If anyone has a better solution be my guest.
-            if x not in trade_data[side]["items"]:
-                trade_data[side]["items"][x] = {}
-        for item in trade_data[side][
-            "items"
-        ].values():  # Making sure all used indexes are in items for above reason.
-            for x in var_filter:
-                if x not in item:
-                    item[x] = ""
-            for x in [
-                "recentAveragePrice",
-                "roliValue",
-            ]:  # Same as above, but setting to 0 so total calculations don't scream.
-                if x not in item:
-                    item[x] = 0
-
-    give_rap = sum(
-        int(item["recentAveragePrice"]) for item in trade_data["give"]["items"].values()
-    )
-    take_rap = sum(
-        int(item["recentAveragePrice"]) for item in trade_data["take"]["items"].values()
-    )
-
-    give_roli_value = sum(
-        int(item["roliValue"]) for item in trade_data["give"]["items"].values()
-    )
-    take_roli_value = sum(
-        int(item["roliValue"]) for item in trade_data["take"]["items"].values()
-    )
-
-    give_robux = str(trade_data["give"]["robux"])
-    take_robux = str(trade_data["take"]["robux"])
-
-    give_user_id = str(trade_data["give"]["user"]["id"])
-    take_user_id = str(trade_data["take"]["user"]["id"])
-    give_user_name = trade_data["give"]["user"]["name"]
-    take_user_name = trade_data["take"]["user"]["name"]
-    give_user_display_name = trade_data["give"]["user"]["displayName"]
-    take_user_display_name = trade_data["take"]["user"]["displayName"]
-
-    trade_status = trade_data["status"]
-
-    text = text.format(
-        give_rap=give_rap,
-        take_rap=take_rap,
-        give_roli_value=give_roli_value,
-        take_roli_value=take_roli_value,
-        give_robux=give_robux,
-        take_robux=take_robux,
-        give_user_id=give_user_id,
-        take_user_id=take_user_id,
-        give_user_name=give_user_name,
-        take_user_name=take_user_name,
-        give_user_display_name=give_user_display_name,
-        take_user_display_name=take_user_display_name,
-        trade_status=trade_status,
-        give_item1_id=str(trade_data["give"]["items"]["item1"]["id"]),
-        give_item2_id=str(trade_data["give"]["items"]["item2"]["id"]),
-        give_item3_id=str(trade_data["give"]["items"]["item3"]["id"]),
-        give_item4_id=str(trade_data["give"]["items"]["item4"]["id"]),
-        take_item1_id=str(trade_data["take"]["items"]["item1"]["id"]),
-        take_item2_id=str(trade_data["take"]["items"]["item2"]["id"]),
-        take_item3_id=str(trade_data["take"]["items"]["item3"]["id"]),
-        take_item4_id=str(trade_data["take"]["items"]["item4"]["id"]),
-        give_item1_serial_number=str(
-            trade_data["give"]["items"]["item1"]["serialNumber"]
-        ),
-        give_item2_serial_number=str(
-            trade_data["give"]["items"]["item2"]["serialNumber"]
-        ),
-        give_item3_serial_number=str(
-            trade_data["give"]["items"]["item3"]["serialNumber"]
-        ),
-        give_item4_serial_number=str(
-            trade_data["give"]["items"]["item4"]["serialNumber"]
-        ),
-        take_item1_serial_number=str(
-            trade_data["take"]["items"]["item1"]["serialNumber"]
-        ),
-        take_item2_serial_number=str(
-            trade_data["take"]["items"]["item2"]["serialNumber"]
-        ),
-        take_item3_serial_number=str(
-            trade_data["take"]["items"]["item3"]["serialNumber"]
-        ),
-        take_item4_serial_number=str(
-            trade_data["take"]["items"]["item4"]["serialNumber"]
-        ),
-        give_item1_asset_id=str(trade_data["give"]["items"]["item1"]["assetId"]),
-        give_item2_asset_id=str(trade_data["give"]["items"]["item2"]["assetId"]),
-        give_item3_asset_id=str(trade_data["give"]["items"]["item3"]["assetId"]),
-        give_item4_asset_id=str(trade_data["give"]["items"]["item4"]["assetId"]),
-        take_item1_asset_id=str(trade_data["take"]["items"]["item1"]["assetId"]),
-        take_item2_asset_id=str(trade_data["take"]["items"]["item2"]["assetId"]),
-        take_item3_asset_id=str(trade_data["take"]["items"]["item3"]["assetId"]),
-        take_item4_asset_id=str(trade_data["take"]["items"]["item4"]["assetId"]),
-        give_item1_name=trade_data["give"]["items"]["item1"]["name"],
-        give_item2_name=trade_data["give"]["items"]["item2"]["name"],
-        give_item3_name=trade_data["give"]["items"]["item3"]["name"],
-        give_item4_name=trade_data["give"]["items"]["item4"]["name"],
-        take_item1_name=trade_data["take"]["items"]["item1"]["name"],
-        take_item2_name=trade_data["take"]["items"]["item2"]["name"],
-        take_item3_name=trade_data["take"]["items"]["item3"]["name"],
-        take_item4_name=trade_data["take"]["items"]["item4"]["name"],
-        give_item1_recent_average_price=str(
-            trade_data["give"]["items"]["item1"]["recentAveragePrice"]
-        ),
-        give_item2_recent_average_price=str(
-            trade_data["give"]["items"]["item2"]["recentAveragePrice"]
-        ),
-        give_item3_recent_average_price=str(
-            trade_data["give"]["items"]["item3"]["recentAveragePrice"]
-        ),
-        give_item4_recent_average_price=str(
-            trade_data["give"]["items"]["item4"]["recentAveragePrice"]
-        ),
-        take_item1_recent_average_price=str(
-            trade_data["take"]["items"]["item1"]["recentAveragePrice"]
-        ),
-        take_item2_recent_average_price=str(
-            trade_data["take"]["items"]["item2"]["recentAveragePrice"]
-        ),
-        take_item3_recent_average_price=str(
-            trade_data["take"]["items"]["item3"]["recentAveragePrice"]
-        ),
-        take_item4_recent_average_price=str(
-            trade_data["take"]["items"]["item4"]["recentAveragePrice"]
-        ),
-        give_item1_original_price=str(
-            trade_data["give"]["items"]["item1"]["originalPrice"]
-        ),
-        give_item2_original_price=str(
-            trade_data["give"]["items"]["item2"]["originalPrice"]
-        ),
-        give_item3_original_price=str(
-            trade_data["give"]["items"]["item3"]["originalPrice"]
-        ),
-        give_item4_original_price=str(
-            trade_data["give"]["items"]["item4"]["originalPrice"]
-        ),
-        take_item1_original_price=str(
-            trade_data["take"]["items"]["item1"]["originalPrice"]
-        ),
-        take_item2_original_price=str(
-            trade_data["take"]["items"]["item2"]["originalPrice"]
-        ),
-        take_item3_original_price=str(
-            trade_data["take"]["items"]["item3"]["originalPrice"]
-        ),
-        take_item4_original_price=str(
-            trade_data["take"]["items"]["item4"]["originalPrice"]
-        ),
-        give_item1_asset_stock=str(trade_data["give"]["items"]["item1"]["assetStock"]),
-        give_item2_asset_stock=str(trade_data["give"]["items"]["item2"]["assetStock"]),
-        give_item3_asset_stock=str(trade_data["give"]["items"]["item3"]["assetStock"]),
-        give_item4_asset_stock=str(trade_data["give"]["items"]["item4"]["assetStock"]),
-        take_item1_asset_stock=str(trade_data["take"]["items"]["item1"]["assetStock"]),
-        take_item2_asset_stock=str(trade_data["take"]["items"]["item2"]["assetStock"]),
-        take_item3_asset_stock=str(trade_data["take"]["items"]["item3"]["assetStock"]),
-        take_item4_asset_stock=str(trade_data["take"]["items"]["item4"]["assetStock"]),
-        give_item1_roli_value=str(trade_data["give"]["items"]["item1"]["roliValue"]),
-        give_item2_roli_value=str(trade_data["give"]["items"]["item2"]["roliValue"]),
-        give_item3_roli_value=str(trade_data["give"]["items"]["item3"]["roliValue"]),
-        give_item4_roli_value=str(trade_data["give"]["items"]["item4"]["roliValue"]),
-        take_item1_roli_value=str(trade_data["take"]["items"]["item1"]["roliValue"]),
-        take_item2_roli_value=str(trade_data["take"]["items"]["item2"]["roliValue"]),
-        take_item3_roli_value=str(trade_data["take"]["items"]["item3"]["roliValue"]),
-        take_item4_roli_value=str(trade_data["take"]["items"]["item4"]["roliValue"]),
-    )
-
-    return text
-
-
-async def check_for_update(current_version: str):
+async def check_for_update(current_version: str, client: httpx.AsyncClient = None):
     """Checks if provided current_version variable matches that of tag_name on the latest release GitHub API. Returns the latest version tag if there is an update."""
-    async with httpx.AsyncClient() as client:
+    async with client_or_temporary(client) as client:
         logger.debug("Checking for Horizon update")
         request = await client.get(
             "https://api.github.com/repos/JartanFTW/Trade-Notifier/releases/latest"
@@ -500,15 +406,23 @@ async def check_for_update(current_version: str):
         )
 
 
-async def check_for_update_loop(current_version: str, webhook_url: str = None):
-    """Checks for an update every 60 minutes, and if it finds one sends an alert to the webhook provided."""
+async def check_for_update_loop(
+    current_version: str, webhook_url: str = None, clients=None
+):
+    """Checks for an update every 60 minutes, and if it finds one sends an alert to the webhook provided.
+    clients should be the ClientRegistry to use pooled github and discord clients from, or None to use temporary ones
+    """
     while True:
-        update = await check_for_update(current_version)
+        update = await check_for_update(
+            current_version, client=clients.get("github") if clients else None
+        )
         if update:
             print_timestamp(f"A new update is available! Version {update}")
             logging.info(f"A new update is available! Version {update}")
             if webhook_url:
-                async with httpx.AsyncClient() as client:
+                async with client_or_temporary(
+                    clients.get("discord") if clients else None
+                ) as client:
                     webhook = Webhook.from_url(
                         webhook_url, adapter=HttpxWebhookAdapter(client)
                     )
@@ -0,0 +1,102 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import asyncio
+import logging
+import time
+import traceback
+
+# Third Party
+import httpx
+
+# Local
+from pipeline import TradeJob
+from rate_limiter import RateLimited
+from utilities import print_timestamp
+
+logger = logging.getLogger("horizon.verification")
+
+
+class VerificationQueue:
+    """Double-checks a TradeWorker's new trades before they're notified, as fake trades disappear from the trade list shortly after showing up.
+    Trades wait here until delay seconds after they were detected. Then every trade that's due is checked against a single
+    refreshed trade list, so a burst of trades costs one extra request rather than one each. Trades still listed are
+    submitted to the pipeline, and the rest are dropped.
+    """
+
+    def __init__(self, worker, delay: float = 10, limit: int = 100):
+        self.worker = worker
+        self.delay = delay
+        self.limit = limit
+        self.pending = []  # TradeJobs in the order they were detected
+        self.task = None
+
+    def add(self, job: TradeJob):
+        """Queues a job to be double-checked, without waiting for the check"""
+        print_timestamp(
+            f"{self.worker.user.display_name:>{self.worker.max_username_length}} | Double-checking {self.worker.trade_type} trade: {job.trade['id']}"
+        )
+        self.pending.append(job)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        """Checks due trades until none are left pending"""
+        while self.pending:
+            await asyncio.sleep(
+                max(0, self.pending[0].detected + self.delay - time.monotonic())
+            )
+            try:
+                await self.check()
+            except Exception:
+                logger.error(
+                    f"{self.worker.user.display_name:>{self.worker.max_username_length}} | Unknown error while double-checking {self.worker.trade_type} trades: {traceback.format_exc()}"
+                )
+                await asyncio.sleep(5)
+        self.task = None
+
+    async def check(self):
+        """Checks every due trade against one trade list and submits the real ones to the pipeline"""
+        worker = self.worker
+        now = time.monotonic()
+        due = [job for job in self.pending if job.detected + self.delay <= now]
+        while True:
+            try:
+                trades_info = await worker.user.get_trade_status_info(
+                    tradeStatusType=worker.trade_type, limit=self.limit
+                )
+                break
+            except (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.ConnectError):
+                logger.warning(
+                    f"{worker.user.display_name:>{worker.max_username_length}} | Timed out while trying to grab {worker.trade_type} trade status info: {traceback.format_exc()}"
+                )
+                print_timestamp(
+                    f"{worker.user.display_name:>{worker.max_username_length}} | Timed out while trying to grab {worker.trade_type} trade status info"
+                )
+                await asyncio.sleep(5)
+            except RateLimited:
+                await asyncio.sleep(5)
+        self.pending = self.pending[len(due) :]  # Only once the list is in, so an error leaves these to be checked again
+
+        listed = set(trade["id"] for trade in trades_info["data"])
+        for job in due:
+            if job.trade["id"] not in listed:
+                print_timestamp(
+                    f"{worker.user.display_name:>{worker.max_username_length}} | {worker.trade_type} trade {job.trade['id']} detected as fake, skipping notification"
+                )
+                worker.finish(job)
+                continue
+            await worker.pipeline.submit(job)
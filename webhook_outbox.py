@@ -0,0 +1,323 @@
+#  Copyright 2021 Jonathan Carter
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+# Standard Library
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import random
+import sqlite3
+import time
+import traceback
+
+# Third Party
+import httpx
+
+# Local
+from metrics import metrics
+from utilities import print_timestamp
+
+logger = logging.getLogger("horizon.webhook_outbox")
+
+
+class WebhookOutbox:
+    """Durable queue of rendered notifications waiting to be sent to discord, stored in an SQLite database.
+    Notifications are saved as soon as they're rendered and only removed once discord accepts them, so they survive
+    discord outages and restarts. Each webhook url has its own delivery worker that sends its notifications in order,
+    keeping within the webhook's rate limit bucket as reported by discord's X-RateLimit headers.
+    The database is only used from one background thread, so writing multi-megabyte images never blocks the event loop.
+    With coalesce on, notifications for the same webhook added within coalesce_window seconds of each other are sent
+    together as one message, up to discord's limits of max_files attachments and max_bytes in total.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        client: httpx.AsyncClient = None,
+        max_delay: float = 60,
+        coalesce: bool = False,
+        coalesce_window: float = 2,
+        max_files: int = 10,
+        max_bytes: int = 8 * 1024 * 1024,
+    ):
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.path = path
+        self.client = client
+        self.max_delay = max_delay
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.database = sqlite3.connect(path, check_same_thread=False)
+        self.database.execute(
+            """CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                webhook_url TEXT NOT NULL,
+                content TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                data BLOB NOT NULL,
+                name TEXT NOT NULL,
+                description TEXT NOT NULL,
+                created REAL NOT NULL
+            )"""
+        )
+        self.database.commit()
+        self.count = self.database.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        self.wakes = {}  # webhook url: asyncio.Event set when a notification is added
+        self.tasks = {}  # webhook url: delivery worker task
+        self.callbacks = {}  # notification id: on_sent function
+        self.sent = 0
+        self.failed = 0
+        self.messages = 0  # Messages sent, fewer than sent when notifications are coalesced
+        self.rate_limited = 0
+        self.retries = 0
+
+    async def execute(self, function, *args):
+        """Runs function, which uses the database, on the database thread"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def put(
+        self,
+        webhook_url: str,
+        content: str,
+        filename: str,
+        data: bytes,
+        name: str = "",
+        description: str = "",
+        on_sent=None,
+    ):
+        """Saves a notification to be sent to webhook_url. name and description are printed once it's sent.
+        on_sent is called with no arguments once discord accepts the notification, unless Horizon restarts before then.
+        """
+        notification_id = await self.execute(
+            self.insert, webhook_url, content, filename, data, name, description
+        )
+        self.count += 1
+        if on_sent is not None:
+            self.callbacks[notification_id] = on_sent
+        self.start(webhook_url)
+        self.wakes[webhook_url].set()
+
+    def insert(
+        self,
+        webhook_url: str,
+        content: str,
+        filename: str,
+        data: bytes,
+        name: str,
+        description: str,
+    ):
+        cursor = self.database.execute(
+            "INSERT INTO outbox (webhook_url, content, filename, data, name, description, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (webhook_url, content, filename, data, name, description, time.time()),
+        )
+        self.database.commit()
+        return cursor.lastrowid
+
+    def start(self, webhook_url: str):
+        if webhook_url not in self.tasks:
+            self.wakes[webhook_url] = asyncio.Event()
+            self.tasks[webhook_url] = asyncio.create_task(self.deliver(webhook_url))
+
+    def pending(self):
+        """Returns how many notifications are waiting to be sent"""
+        return self.count
+
+    async def run(self):
+        """Resumes delivering notifications left over from the last run. Delivery workers for new webhook urls start as notifications are added."""
+        webhook_urls = await self.execute(self.webhook_urls)
+        if webhook_urls:
+            logger.info(
+                f"Resuming delivery of {self.pending()} notifications from {self.path}"
+            )
+        for webhook_url in webhook_urls:
+            self.start(webhook_url)
+
+    def webhook_urls(self):
+        return [
+            row[0]
+            for row in self.database.execute("SELECT DISTINCT webhook_url FROM outbox")
+        ]
+
+    def next_batch(self, webhook_url: str, max_files: int):
+        """Returns the oldest notifications for webhook_url that fit in one message, as rows of
+        (id, content, filename, data, name, description, created)
+        """
+        rows = self.database.execute(
+            "SELECT id, content, filename, data, name, description, created FROM outbox WHERE webhook_url = ? ORDER BY id LIMIT ?",
+            (webhook_url, max_files),
+        ).fetchall()
+        batch = []
+        size = 0
+        content = ""
+        for row in rows:
+            size += len(row[3])
+            if row[1]:
+                content = f"{content}\n{row[1]}" if content else row[1]
+            if batch and (size > self.max_bytes or len(content) > 2000):
+                break
+            batch.append(row)
+        return batch
+
+    async def deliver(self, webhook_url: str):
+        """Sends webhook_url's notifications oldest first, forever"""
+        wake = self.wakes[webhook_url]
+        resets_at = 0  # When the webhook's rate limit bucket next refills, if it's empty
+        attempt = 0
+        max_files = self.max_files if self.coalesce else 1
+        separate_until = 0  # Notifications up to this id are sent one at a time after discord rejected them together
+        while True:
+            try:
+                batch = await self.execute(self.next_batch, webhook_url, max_files)
+                if not batch:
+                    wake.clear()
+                    await wake.wait()
+                    continue
+                if batch[0][0] <= separate_until:
+                    batch = batch[:1]
+                elif self.coalesce and len(batch) < max_files:
+                    delay = batch[0][6] + self.coalesce_window - time.time()
+                    if delay > 0:  # Give other notifications a chance to join the message
+                        await asyncio.sleep(delay)
+                        continue
+
+                delay = resets_at - time.monotonic()
+                if delay > 0:
+                    logger.debug(f"Waiting {delay:.2f}s for webhook rate limit bucket to refill")
+                    await asyncio.sleep(delay)
+
+                content = "\n".join(row[1] for row in batch if row[1])
+                if len(batch) == 1:
+                    files = {"file": (batch[0][2], batch[0][3])}
+                else:
+                    files = {
+                        f"file{i}": (f"{i + 1}_{row[2]}", row[3])
+                        for i, row in enumerate(batch)
+                    }
+                try:
+                    with metrics.timer("horizon_webhook_request_seconds"):
+                        response = await self.client.post(
+                            webhook_url, data={"content": content[:2000]}, files=files
+                        )
+                except httpx.RequestError:
+                    attempt += 1
+                    self.retries += 1
+                    logger.warning(
+                        f"Couldn't reach discord while sending webhook, retrying: {traceback.format_exc()}"
+                    )
+                    await asyncio.sleep(self.retry_delay(attempt))
+                    continue
+
+                if response.headers.get("X-RateLimit-Remaining") == "0":
+                    resets_at = time.monotonic() + self.reset_after(response)
+                else:
+                    resets_at = 0
+
+                if 200 <= response.status_code < 300:
+                    attempt = 0
+                    self.messages += 1
+                    for notification_id, _, _, _, name, description, _ in batch:
+                        await self.remove(notification_id)
+                        self.sent += 1
+                        logger.info(f"{name} | Sent {description}")
+                        print_timestamp(f"{name} | Sent {description}")
+                        self.run_callback(notification_id)
+                elif response.status_code == 429:
+                    self.rate_limited += 1
+                    resets_at = time.monotonic() + self.reset_after(response)
+                    logger.warning(
+                        f"Webhook is rate limited, retrying in {resets_at - time.monotonic():.2f} seconds"
+                    )
+                elif response.status_code >= 500:
+                    attempt += 1
+                    self.retries += 1
+                    logger.warning(
+                        f"Discord responded {response.status_code} while sending webhook, retrying"
+                    )
+                    await asyncio.sleep(self.retry_delay(attempt))
+                elif len(batch) > 1:  # Retry one at a time, so only the notification discord objects to is dropped
+                    logger.warning(
+                        f"Discord rejected {len(batch)} coalesced notifications with {response.status_code}, sending them separately"
+                    )
+                    separate_until = batch[-1][0]
+                else:  # Discord won't ever accept this notification, so there's no point keeping it
+                    attempt = 0
+                    notification_id, _, _, _, name, description, _ = batch[0]
+                    await self.remove(notification_id)
+                    self.callbacks.pop(notification_id, None)
+                    self.failed += 1
+                    logger.error(
+                        f"{name} | Discord rejected {description} with {response.status_code}: {response.text}"
+                    )
+                    print_timestamp(f"{name} | Failed to send {description}")
+            except Exception:  # Keep this webhook's worker alive, as nothing restarts it
+                attempt += 1
+                logger.error(
+                    f"Unknown error while delivering webhook: {traceback.format_exc()}"
+                )
+                await asyncio.sleep(self.retry_delay(attempt))
+
+    def run_callback(self, notification_id: int):
+        on_sent = self.callbacks.pop(notification_id, None)
+        if on_sent is None:
+            return
+        try:
+            on_sent()
+        except Exception:
+            logger.error(f"Error in webhook sent callback: {traceback.format_exc()}")
+
+    def collect(self):
+        """Returns metrics samples for how many notifications are waiting and how delivery has gone"""
+        return [
+            ("horizon_queue_depth", {"queue": "outbox"}, self.pending()),
+            ("horizon_webhook_notifications_total", {"result": "sent"}, self.sent),
+            ("horizon_webhook_notifications_total", {"result": "rejected"}, self.failed),
+            ("horizon_webhook_messages_total", {}, self.messages),
+            ("horizon_webhook_rate_limited_total", {}, self.rate_limited),
+            ("horizon_webhook_retries_total", {}, self.retries),
+        ]
+
+    async def remove(self, notification_id: int):
+        await self.execute(self.delete, notification_id)
+        self.count -= 1
+
+    def delete(self, notification_id: int):
+        self.database.execute("DELETE FROM outbox WHERE id = ?", (notification_id,))
+        self.database.commit()
+
+    def reset_after(self, response: httpx.Response):
+        """Returns how many seconds until a webhook's rate limit bucket refills, from discord's response headers"""
+        for header in ("X-RateLimit-Reset-After", "Retry-After"):
+            try:
+                return min(self.max_delay, max(0, float(response.headers[header])))
+            except (KeyError, ValueError):
+                continue
+        return 1
+
+    def retry_delay(self, attempt: int):
+        """Returns how long to wait before retrying after a failed attempt, growing exponentially with jitter"""
+        delay = min(self.max_delay, 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def close(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.executor.shutdown(wait=True)
+        self.database.close()